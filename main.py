@@ -2,13 +2,16 @@
 智能群聊上下文增强插件
 通过多维度信息收集和分层架构，为 LLM 提供丰富的群聊语境，支持角色扮演，完全兼容人设系统。
 """
-import traceback
+import contextlib
 import json
+import logging
 import re
+import string
+import sys
 import datetime
-import heapq
 import itertools
-from collections import deque, defaultdict
+import operator
+from collections import deque
 import os
 from typing import Dict, Optional
 from asyncio import Lock
@@ -16,9 +19,12 @@ import time
 import uuid
 from dataclasses import dataclass
 import asyncio
-import aiofiles
-import aiofiles.os as aio_os
-from aiofiles.os import remove as aio_remove, rename as aio_rename
+from aiofiles.os import remove as aio_remove
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from astrbot.api.event import filter as event_filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register, StarTools
@@ -44,20 +50,192 @@ class ContextMessageType:
     BOT_REPLY = "bot_reply"
 
 
+def _intern(value):
+    """驻留字符串，使同一发送者/群组的大量消息共享同一个 str 对象；非 str 值原样返回"""
+    return sys.intern(value) if type(value) is str else value
+
+
+# 按时间戳排序消息的键函数；attrgetter 由 C 实现，省去每个元素一次 lambda 调用
+_timestamp_key = operator.attrgetter("timestamp")
+
+
+def _merge_buffers(buffers: "GroupMessageBuffers") -> list:
+    """
+    将群组的三个缓冲区合并为按时间排序的列表。
+    各缓冲区自身基本有序，timsort 会识别这些有序段并近似线性地归并，
+    比 heapq.merge 少了 Python 层的堆操作和键包装；排序是稳定的，同一时间戳的顺序与之前一致。
+    """
+    return sorted(
+        itertools.chain(buffers.recent_chats, buffers.bot_replies, buffers.image_messages),
+        key=_timestamp_key,
+    )
+
+
+def _dumps_cache(data) -> bytes:
+    """序列化缓存数据为 bytes，优先使用 orjson，不可用时回退到标准库 json；无法序列化的字段直接抛出异常"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def _loads_cache(content: bytes):
+    """反序列化缓存数据，优先使用 orjson，不可用时回退到标准库 json"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def _read_bytes(path: str) -> Optional[bytes]:
+    """一次性读取整个文件，文件不存在时返回 None"""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _append_bytes(path: str, data: bytes):
+    """以追加模式一次性写入一批日志行"""
+    with open(path, "ab") as f:
+        f.write(data)
+
+
+def _remove_if_exists(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _loaded_message_target(msg_data: dict) -> str:
+    """恢复的消息应进入的缓冲区名称，与 _dispatch_loaded_message 的分发规则保持一致"""
+    if msg_data.get("message_type") == ContextMessageType.BOT_REPLY:
+        return "bot_replies"
+    if msg_data.get("images"):
+        return "image_messages"
+    return "recent_chats"
+
+
+def _read_log_tail(path: str, capacity: Dict[str, int], max_groups: int):
+    """
+    逐行流式读取追加日志（在线程中执行），文件不存在时返回 None。
+    每个群组的每个缓冲区只保留容量以内的最新原始记录，群组数也不超过 max_groups，
+    内存占用只取决于缓存上限而与日志长度无关。
+    返回 (groups, dropped, skipped)：
+      groups  -- {群号: [是否需先清空已有消息, {缓冲区名: deque(消息字典)}]}，按最近写入顺序排列
+      dropped -- 被清空标记作废或因超出 max_groups 被挤出、需从快照中一并移除的群号
+      skipped -- 无法解析而跳过的行数
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+    def new_state(cleared: bool) -> list:
+        return [cleared, {name: deque(maxlen=size) for name, size in capacity.items()}]
+
+    groups: Dict[str, list] = {}
+    dropped = set()
+    skipped = 0
+    with f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = _loads_cache(line)
+                group_id = record["g"]
+                msg_data = None if record.get("clear") else record["m"]
+                if msg_data is not None and not isinstance(msg_data, dict):
+                    raise ValueError("消息记录不是字典")
+            except Exception:
+                # 进程崩溃时最后一行可能只写了一半，跳过即可
+                skipped += 1
+                continue
+
+            state = groups.pop(group_id, None)
+            if msg_data is None:
+                # 清空标记：快照以及此前日志中该群组的消息全部作废，且不占用群组名额
+                dropped.add(group_id)
+                continue
+            if state is None:
+                # 被清空或挤出的群组再次出现时，与运行期一致，只保留之后的消息
+                state = new_state(group_id in dropped)
+                dropped.discard(group_id)
+            # 重新插入到末尾，使 groups 按最近写入顺序排列
+            groups[group_id] = state
+            state[1][_loaded_message_target(msg_data)].append(msg_data)
+            if len(groups) > max_groups:
+                oldest = next(iter(groups))
+                del groups[oldest]
+                dropped.add(oldest)
+    return groups, dropped, skipped
+
+
+def _atomic_write_bytes(path: str, temp_path: str, data: bytes):
+    """在同一次线程调用中完成 写入临时文件 -> fsync -> 原子替换"""
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+        # 只对临时文件 fsync，确保替换前数据已落盘
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    # os.replace 在目标已存在时同样是原子的，Windows 下也不会失败
+    os.replace(temp_path, path)
+
+
+def _compile_instruction(template: str):
+    """
+    将指令模板预解析为 (字面文本, 字段名) 片段，渲染时只需按片段拼接，不必每次重新解析模板。
+    模板含格式说明符、转换符或属性/下标访问等写法时，回退为 template.format，行为保持不变。
+    """
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError:
+        return template.format  # 模板本身有误，与原先一样在渲染时报错
+    if any(spec or conversion or (name is not None and not name.isidentifier())
+           for _, name, spec, conversion in parsed):
+        return template.format
+    pieces = [(literal, name) for literal, name, _, _ in parsed]
+
+    def render(**kwargs) -> str:
+        return "".join([
+            literal if name is None else literal + str(kwargs[name])
+            for literal, name in pieces
+        ])
+    return render
+
+
 # 常量定义 - 避免硬编码
 class ContextConstants:
     """插件中使用的常量"""
     MESSAGE_MATCH_TIME_WINDOW = 3
+    IMAGE_CAPTION_CONCURRENCY = 3  # 同时进行图片转述的消息数上限
+    RESET_COMMANDS = frozenset({"reset", "new"})
+    SECONDS_PER_DAY = 86400
+    MAX_CACHED_GROUPS = 500  # 内存中最多缓存的群组数，超出时淘汰最久未活跃的群组
+    PERSIST_BATCH_SIZE = 50  # 追加日志每次写盘最多合并的记录数
     PROMPT_HEADER = "你正在浏览聊天软件，查看群聊消息。"
     RECENT_CHATS_HEADER = "\n最近的聊天记录:"
     BOT_REPLIES_HEADER = "\n你最近的回复:"
     PROMPT_FOOTER = "请基于以上信息，并严格按照你的角色设定，做出自然且符合当前对话氛围的回复。"
 
 
-@dataclass
+@dataclass(frozen=True)
 class PluginConfig:
-    """统一管理插件配置项"""
-    enabled_groups: list
+    """统一管理插件配置项（只读：指令模板、前缀首字符等派生状态都在初始化时根据它预先计算）"""
+    # 手动声明 __slots__ 以兼容 Python 3.10 以下不支持 dataclass(slots=True) 的版本
+    __slots__ = (
+        "enabled_groups", "recent_chats_count", "bot_replies_count", "collect_bot_replies",
+        "max_images_in_context", "enable_image_caption", "image_caption_provider_id",
+        "image_caption_prompt", "image_caption_timeout", "cleanup_interval_seconds",
+        "inactive_cleanup_days", "command_prefixes", "duplicate_check_window_messages",
+        "duplicate_check_time_seconds", "passive_reply_instruction", "active_speech_instruction",
+    )
+    enabled_groups: frozenset  # 集合形式，逐条消息的启用检查为 O(1)
     recent_chats_count: int
     bot_replies_count: int
     collect_bot_replies: bool
@@ -68,23 +246,88 @@ class PluginConfig:
     image_caption_timeout: int
     cleanup_interval_seconds: int
     inactive_cleanup_days: int
-    command_prefixes: list
+    command_prefixes: tuple  # 元组形式，可直接传给 str.startswith
     duplicate_check_window_messages: int
     duplicate_check_time_seconds: int
     passive_reply_instruction: str  # 被动回复指令
     active_speech_instruction: str  # 主动发言指令
 
 
+class DuplicateIndex:
+    """
+    最近 N 条消息的 (发送者, 文本) 签名索引，用于 O(1) 防重复检查。
+    窗口与缓冲区的追加顺序保持一致，签名映射到其最近一次出现的时间戳。
+    """
+    def __init__(self, window_size: int):
+        self.window: deque = deque(maxlen=max(window_size, 0))
+        self.last_seen: Dict[tuple, float] = {}
+
+    def get_last_seen(self, msg: "GroupMessage") -> Optional[float]:
+        return self.last_seen.get((msg.sender_id, msg.text_content))
+
+    def record(self, msg: "GroupMessage"):
+        """记录一条已追加到缓冲区的消息，并淘汰滑出窗口的签名"""
+        if not self.window.maxlen:
+            return
+        signature = (msg.sender_id, msg.text_content)
+        if len(self.window) == self.window.maxlen:
+            old_signature, old_timestamp = self.window[0]
+            # 仅当被淘汰的是该签名最近一次出现时才移除索引
+            if self.last_seen.get(old_signature) == old_timestamp:
+                del self.last_seen[old_signature]
+        self.window.append((signature, msg.timestamp))
+        self.last_seen[signature] = msg.timestamp
+
+
 @dataclass
 class GroupMessageBuffers:
     """为每个群组管理独立的、按类型划分的消息缓冲区"""
+    # 与 PluginConfig 相同，手动声明 __slots__ 以兼容旧版 Python；
+    # 因此 nonce_index 不能带默认值，由 _create_new_group_buffers 显式传入
+    __slots__ = (
+        "recent_chats", "bot_replies", "image_messages",
+        "recent_chats_index", "bot_replies_index", "nonce_index", "lock",
+    )
     recent_chats: deque
     bot_replies: deque
     image_messages: deque
+    recent_chats_index: DuplicateIndex
+    bot_replies_index: DuplicateIndex
+    # nonce -> 缓冲区中持有该 nonce 的消息，查找触发消息时 O(1) 命中，无需扫描缓冲区
+    nonce_index: Dict[str, "GroupMessage"]
+    # 群组锁与缓冲区放在一起，一次字典查找即可同时取得两者，淘汰群组时也一并释放
+    lock: Lock
+
+    def track_nonce(self, target: deque, msg: "GroupMessage"):
+        """在 msg 追加到 target 之前调用：登记其 nonce，并移除即将被挤出缓冲区的消息的 nonce"""
+        if target.maxlen == 0:
+            # 容量为 0 的缓冲区（如 max_images_in_context 配置为 0）不会保留 msg，登记后将永远无法移除
+            return
+        if target and len(target) == target.maxlen:
+            evicted = target[0]
+            if evicted.nonce and self.nonce_index.get(evicted.nonce) is evicted:
+                del self.nonce_index[evicted.nonce]
+        if msg.nonce:
+            self.nonce_index[msg.nonce] = msg
+
+
+@dataclass
+class ComponentScan:
+    """单次遍历消息组件得到的结果，缓存在事件对象上供各处复用"""
+    text_parts: list
+    images: list
+    at_targets: set  # 被@的ID字符串集合，供 O(1) 成员检查
 
 
 class GroupMessage:
     """群聊消息的独立数据类，与框架解耦"""
+    # 缓存中常驻大量消息实例，使用 __slots__ 省去每个实例的 __dict__
+    __slots__ = (
+        "id", "nonce", "message_type", "timestamp", "sender_id", "sender_name", "group_id",
+        "text_content", "images", "has_image", "image_captions", "raw_components", "caption_task",
+        "_cached_dict",
+    )
+
     def __init__(self,
                  message_type: str,
                  sender_id: str,
@@ -93,41 +336,47 @@ class GroupMessage:
                  text_content: str = "",
                  images: Optional[list[str]] = None,
                  message_id: Optional[str] = None,
-                 nonce: Optional[str] = None,
+                 nonce: Optional[str] = None,  # "<实例前缀>-<自增序号>"，用于匹配触发 LLM 的消息
                  raw_components: Optional[list] = None):
         self.id = message_id
         self.nonce = nonce
         self.message_type = message_type
-        self.timestamp = datetime.datetime.now()
-        self.sender_id = sender_id
-        self.sender_name = sender_name
-        self.group_id = group_id
+        self.timestamp = time.time()  # UNIX 时间戳 (float)
+        # 这几个短字符串在同一群的消息间大量重复，驻留后共享存储，比较时也可走身份快速路径
+        self.sender_id = _intern(sender_id)
+        self.sender_name = _intern(sender_name)
+        self.group_id = _intern(group_id)
         self.text_content = text_content
-        self.images = images or []
+        self.images = images or []  # 已解析的图片 URL 字符串，序列化时直接复用
         self.has_image = len(self.images) > 0
         self.image_captions: list[str] = []
         self.raw_components = raw_components or []
+        # 正在进行中的图片描述任务（仅运行时使用，不持久化），并发请求据此共享同一次生成
+        self.caption_task: Optional[asyncio.Future] = None
+        # to_dict() 的缓存结果；消息入队后基本不再变化，修改字段后需调用 invalidate_dict_cache()
+        self._cached_dict: Optional[dict] = None
+
+    @property
+    def display_text(self) -> str:
+        """用于构建上下文的文本：原始文本，若已生成图片描述则附加在末尾"""
+        if not self.image_captions:
+            return self.text_content
+        return f"{self.text_content}[Image: {'; '.join(self.image_captions)}]"
+
+    def invalidate_dict_cache(self):
+        """消息字段被修改后调用，使下一次 to_dict() 重新序列化"""
+        self._cached_dict = None
 
     def to_dict(self) -> dict:
-        """将消息对象转换为可序列化为 JSON 的字典"""
-        # 序列化 raw_components
-        serializable_components = []
-        for comp in self.raw_components:
-            if hasattr(comp, 'to_dict'):
-                serializable_components.append(comp.to_dict())
-            else:
-                # 对于没有 to_dict 方法的组件，尝试转换为字符串
-                try:
-                    # 修复 #3: 改进对未知组件的序列化处理
-                    serializable_components.append({"type": comp.__class__.__name__, "content": str(comp)})
-                except Exception:
-                    serializable_components.append({"type": "unknown", "content": str(comp)})
+        """将消息对象转换为可序列化为 JSON 的字典（结果会被缓存，调用方不应修改返回值）"""
+        if self._cached_dict is not None:
+            return self._cached_dict
 
-        return {
+        self._cached_dict = {
             "id": self.id,
             "nonce": self.nonce,
             "message_type": self.message_type,
-            "timestamp": self.timestamp.isoformat(),
+            "timestamp": self.timestamp,  # 直接存储 UNIX 时间戳，避免 ISO 字符串的格式化与解析
             "sender_name": self.sender_name,
             "sender_id": self.sender_id,
             "group_id": self.group_id,
@@ -135,16 +384,16 @@ class GroupMessage:
             "has_image": self.has_image,
             "image_captions": self.image_captions,
             "images": self.images,  # 直接存储 URL 列表
-            "raw_components": serializable_components
+            # raw_components 不再持久化：恢复后只能是无法还原为组件对象的字典，
+            # 下游只使用 text_content / images / image_captions，写入它只会增大缓存并拖慢保存
         }
+        return self._cached_dict
 
     @classmethod
     def from_dict(cls, data: dict):
         """从字典创建 GroupMessage 对象"""
-        # 注意：从字典恢复 raw_components 较为复杂，
-        # 这里我们只恢复其字典形式，因为原始对象类型信息已丢失。
-        # 如果需要完全恢复，需要一个组件工厂函数。
-        # 目前的实现对于数据存储和传输是足够的。
+        # 注意：raw_components 无法从字典还原为组件对象，新缓存中也不再写入；
+        # 旧版缓存中的 raw_components 仍按字典形式读入，以保持兼容。
        # 修复 #1: 增强向后兼容性，使用 .get() 并提供默认值
         instance = cls(
            message_type=data.get("message_type", ContextMessageType.NORMAL_CHAT),
@@ -158,9 +407,23 @@ class GroupMessage:
            raw_components=data.get("raw_components", [])
         )
         # 时间戳是核心字段，如果缺少则可能无法处理，但仍尝试提供默认值
-        timestamp_str = data.get("timestamp")
-        instance.timestamp = datetime.datetime.fromisoformat(timestamp_str) if timestamp_str else datetime.datetime.now()
+        # 兼容旧版缓存中的 ISO 格式字符串
+        timestamp = data.get("timestamp")
+        if isinstance(timestamp, str):
+            instance.timestamp = datetime.datetime.fromisoformat(timestamp).timestamp()
+        elif timestamp is not None:
+            instance.timestamp = float(timestamp)
+        else:
+            instance.timestamp = time.time()
         instance.image_captions = data.get("image_captions", [])
+        # 旧版缓存（ISO 时间戳）在收集时就把图片描述拼进了 text_content 末尾，image_captions 始终为空；
+        # 把描述拆回 image_captions，否则加载后会被重新生成，并在上下文中出现两次
+        if isinstance(timestamp, str) and instance.images and not instance.image_captions:
+            text = instance.text_content
+            start = text.rfind("[Image: ")
+            if start != -1 and text.endswith("]"):
+                instance.text_content = text[:start]
+                instance.image_captions = text[start + len("[Image: "):-1].split("; ")
        # has_image 属性需要根据恢复的 images 列表重新计算
         instance.has_image = len(instance.images) > 0
         return instance
@@ -185,14 +448,28 @@ class ContextEnhancerV2(Star):
     - 异步处理，不阻塞主流程
     - 完善的错误处理和功能降级
     """
-    # 缓冲区大小乘数，用于为 deque 提供额外空间，避免在消息快速增长时频繁丢弃旧消息
-    CACHE_LOAD_BUFFER_MULTIPLIER = 2
-
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context, config)
         self.raw_config = config
         self.config = self._load_plugin_config()
-        self._global_lock = asyncio.Lock()
+        # 仅当命令前缀包含有大小写之分的字符时，才需要对消息文本做 lower()
+        self._command_prefixes_cased = any(p != p.upper() for p in self.config.command_prefixes)
+        # 各前缀的首字符集合，绝大多数消息只需一次集合查找即可排除；存在空前缀时任何消息都匹配，不使用该快速路径
+        self._command_prefix_firstchars = (
+            None if "" in self.config.command_prefixes
+            else frozenset(p[0] for p in self.config.command_prefixes)
+        )
+        # 指令模板在加载配置时解析一次，每次 LLM 请求只做拼接
+        self._render_passive_instruction = _compile_instruction(self.config.passive_reply_instruction)
+        self._render_active_instruction = _compile_instruction(self.config.active_speech_instruction)
+        self._inactive_cleanup_seconds = self.config.inactive_cleanup_days * ContextConstants.SECONDS_PER_DAY
+        # nonce = 启动时生成一次的实例前缀 + 自增计数，避免每条消息都生成 uuid，
+        # 前缀保证重启后不会与缓存文件中恢复的旧 nonce 冲突
+        self._nonce_prefix = uuid.uuid4().hex[:8]
+        self._nonce_counter = itertools.count()
+        self._caption_semaphore = asyncio.Semaphore(ContextConstants.IMAGE_CAPTION_CONCURRENCY)
+        self._at_pattern_cache: Dict[str, re.Pattern] = {}
+        self._bot_name = self.raw_config.get("name", "助手")
         logger.info("[ContextEnhancerV2] 上下文增强器v2.0已初始化")
 
         # 初始化工具类
@@ -200,62 +477,90 @@ class ContextEnhancerV2(Star):
 
         # 群聊消息缓存 - 每个群独立存储
         self.group_messages: Dict[str, "GroupMessageBuffers"] = {}
-        self.group_locks: defaultdict[str, Lock] = defaultdict(Lock)
-        self.group_last_activity: Dict[str, datetime.datetime] = {}
-        self.last_cleanup_time = time.time()
+        # 活动时间与清理计时只用于进程内比较，使用单调时钟，不受系统时间调整影响
+        self.group_last_activity: Dict[str, float] = {}
+        # 不活跃群组的清理由后台任务定时执行，首次创建缓冲区时启动
+        self._cleanup_task: Optional[asyncio.Task] = None
+        # terminate 开始后置位：不再收集消息、不再创建缓冲区，也不再重新启动后台任务
+        self._closing = False
 
         # 异步加载持久化的上下文
         self.data_dir = os.path.join(
             StarTools.get_data_dir(), "astrbot_plugin_context_enhancer"
         )
-        os.makedirs(self.data_dir, exist_ok=True)
+        # 目录在首次需要时才于线程中创建，避免插件加载时在事件循环中执行阻塞的文件系统调用
+        self._data_dir_ready = False
         self.cache_path = os.path.join(self.data_dir, "context_cache.json")
+        # 追加日志：运行期间增量记录新消息并定期压缩进快照，启动时在快照之后重放，终止时同样合并进快照并删除
+        self.log_path = os.path.join(self.data_dir, "context_cache.log.jsonl")
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        # 队列中的记录带有入队时的代次；压缩把缓存写成快照后提升下限，已被快照覆盖的旧记录不再写入日志
+        self._log_lock = Lock()
+        self._persist_generation = 0
+        self._persist_floor = 0
+        # 上次压缩以来写入追加日志的记录数，定时压缩据此判断是否需要重写快照
+        self._log_records_written = 0
+        # 快照与追加日志只加载一次：由 initialize 触发，或在首次处理事件时惰性触发
+        self._init_task: Optional[asyncio.Future] = None
+        self._loaded = False
         
         # 显示当前配置
         logger.info(f"上下文增强器配置加载完成: {self.config}")
 
+    async def initialize(self):
+        """AstrBot 在插件实例化后调用：加载持久化的上下文"""
+        await self._async_init()
+
     async def _async_init(self):
-        """异步初始化部分，例如加载缓存"""
-        await self._load_cache_from_file()
-        logger.info(f"成功从 {self.cache_path} 异步加载上下文缓存")
+        """异步初始化部分，例如加载缓存。可重复调用，并发的调用方共享同一次加载"""
+        if self._init_task is None:
+            self._init_task = asyncio.ensure_future(self._load_persisted_context())
+        await asyncio.shield(self._init_task)
 
-    async def terminate(self, context: Context):
-        """插件终止时，异步持久化上下文并关闭会话"""
-        # 异步持久化上下文
-        temp_path = self.cache_path + ".tmp"
+    async def _load_persisted_context(self):
+        """加载快照、重放追加日志，并把结果压缩回快照"""
         try:
-            serializable_data = {}
-            for group_id, buffers in self.group_messages.items():
-                # 使用 heapq.merge 高效合并已排序的 deques，并立即转换为列表
-                all_messages = list(heapq.merge(
-                    buffers.recent_chats, buffers.bot_replies, buffers.image_messages, key=lambda msg: msg.timestamp
-                ))
-
-                # 在保存前，根据配置裁剪消息列表，防止缓存文件无限增长
-                max_messages_to_save = self.config.recent_chats_count + self.config.bot_replies_count
-                if len(all_messages) > max_messages_to_save:
-                    all_messages = all_messages[-max_messages_to_save:]
+            await self._ensure_data_dir()
+            await self._load_cache_from_file()
+            log_found = await self._replay_persist_log()
+
+            # 恢复的群组按恢复顺序登记活动时间，使其同样参与定时清理与 LRU 淘汰
+            now = time.monotonic()
+            for group_id in self.group_messages:
+                self.group_last_activity.setdefault(group_id, now)
+            over_limit = len(self.group_messages) > ContextConstants.MAX_CACHED_GROUPS
+            self._evict_least_recent_groups(ContextConstants.MAX_CACHED_GROUPS)
+
+            # 重放过的日志已并入内存，立即压缩，避免日志在多次重启之间无限增长
+            if log_found or over_limit:
+                await self._compact_persisted_cache()
+            logger.info(f"成功从 {self.cache_path} 异步加载上下文缓存")
+        except Exception as e:
+            logger.error(f"[ContextEnhancerV2] 加载持久化上下文失败: {e}")
+        finally:
+            self._loaded = True
 
-                # 序列化
-                serializable_data[group_id] = [msg.to_dict() for msg in all_messages]
+    async def terminate(self, context: Context):
+        """插件终止时，异步持久化上下文并关闭会话"""
+        self._closing = True
+        # 停止定时清理任务，并等待它真正结束，之后的写入不会与其中途的操作交错
+        cleanup_task = self._cleanup_task
+        if cleanup_task is not None:
+            self._cleanup_task = None
+            cleanup_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await cleanup_task
 
-            # 1. 写入临时文件
-            async with aiofiles.open(temp_path, "w", encoding="utf-8") as f:
-                await f.write(json.dumps(serializable_data, ensure_ascii=False, indent=4))
+        # 从未加载过时先完成加载，否则下面写入的快照会覆盖磁盘上尚未读入的缓存
+        if not self._loaded:
+            await self._async_init()
 
-            # 2. 原子性重命名
-            await aio_rename(temp_path, self.cache_path)
-            logger.info(f"上下文缓存已成功原子化保存到 {self.cache_path}")
+        # 先把排队中的追加日志写完，再停止后台写入任务
+        await self._stop_writer()
 
-        except Exception as e:
-            logger.error(f"[ContextEnhancerV2] 异步保存上下文缓存失败: {e}")
-        finally:
-            # 3. 确保清理临时文件
-            if await aio_os.path.exists(temp_path):
-                try:
-                    await aio_remove(temp_path)
-                except Exception as e:
-                    logger.error(f"[ContextEnhancerV2] 清理临时缓存文件 {temp_path} 失败: {e}")
+        # 异步持久化上下文：写入完整快照并丢弃追加日志
+        await self._compact_persisted_cache()
 
         # 关闭 aiohttp session
         if self.image_caption_utils and hasattr(self.image_caption_utils, 'close'):
@@ -265,7 +570,7 @@ class ContextEnhancerV2(Star):
     def _load_plugin_config(self) -> PluginConfig:
         """从原始配置加载并填充插件配置类"""
         return PluginConfig(
-            enabled_groups=[str(g) for g in self.raw_config.get("enabled_groups", [])],
+            enabled_groups=frozenset(str(g) for g in self.raw_config.get("enabled_groups", []) or []),
             recent_chats_count=self.raw_config.get("recent_chats_count", 15),
             bot_replies_count=self.raw_config.get("bot_replies_count", 5),
             max_images_in_context=self.raw_config.get("max_context_images", 4),
@@ -278,7 +583,9 @@ class ContextEnhancerV2(Star):
             image_caption_timeout=self.raw_config.get("image_caption_timeout", 30),
             cleanup_interval_seconds=self.raw_config.get("cleanup_interval_seconds", 600),
             inactive_cleanup_days=self.raw_config.get("inactive_cleanup_days", 7),
-            command_prefixes=self.raw_config.get("command_prefixes", ["/", "!", "！", "#", ".", "。"]),
+            command_prefixes=tuple(
+                str(p).lower() for p in self.raw_config.get("command_prefixes", ["/", "!", "！", "#", ".", "。"])
+            ),
             duplicate_check_window_messages=self.raw_config.get("duplicate_check_window_messages", 5),
             duplicate_check_time_seconds=self.raw_config.get("duplicate_check_time_seconds", 30),
             passive_reply_instruction=self.raw_config.get("passive_reply_instruction", '现在，群成员 {sender_name} (ID: {sender_id}) 正在对你说话，或者提到了你，TA说："{original_prompt}"\n你需要根据以上聊天记录和你的角色设定，直接回复该用户。（不要回复本消息，这只是个提示）'),
@@ -300,25 +607,176 @@ class ContextEnhancerV2(Star):
             logger.error(f"[ContextEnhancerV2] 工具类初始化失败: {e}")
             self.image_caption_utils = None
 
-    def _get_or_create_lock(self, group_id: str) -> Lock:
-        return self.group_locks[group_id]
+    async def _ensure_data_dir(self):
+        """在线程中创建数据目录，每个实例只执行一次"""
+        if not self._data_dir_ready:
+            await asyncio.to_thread(os.makedirs, self.data_dir, exist_ok=True)
+            self._data_dir_ready = True
 
     async def _load_cache_from_file(self):
         """从文件异步加载缓存"""
-        if not await aio_os.path.exists(self.cache_path):
-            return
         try:
-            async with aiofiles.open(self.cache_path, "r", encoding="utf-8") as f:
-                content = await f.read()
-                if content: # 确保文件内容不为空
-                    data = json.loads(content)
-                    self.group_messages = self._load_group_messages_from_dict(data)
-                    logger.info(f"[ContextEnhancerV2] 成功从 {self.cache_path} 异步加载上下文缓存。")
-                else:
-                    logger.info(f"[ContextEnhancerV2] 缓存文件 {self.cache_path} 为空，跳过加载。")
+            # 打开与读取在同一次线程调用中完成，解析交给 orjson 在事件循环中同步执行
+            content = await asyncio.to_thread(_read_bytes, self.cache_path)
+            if content is None:
+                return
+            if content.strip(): # 确保文件内容不为空
+                data = _loads_cache(content)
+                self.group_messages = self._load_group_messages_from_dict(data)
+                logger.info(f"[ContextEnhancerV2] 成功从 {self.cache_path} 异步加载上下文缓存。")
+            else:
+                logger.info(f"[ContextEnhancerV2] 缓存文件 {self.cache_path} 为空，跳过加载。")
         except Exception as e:
             logger.error(f"[ContextEnhancerV2] 异步加载上下文缓存失败: {e}")
 
+    def _enqueue_persist(self, record: dict):
+        """将一条记录放入追加日志队列，首次调用时启动后台写入任务"""
+        if self._write_queue is None:
+            if self._closing:
+                # 终止流程会把内存中的缓存整体写入快照，此时不再重新启动写入任务
+                return
+            self._write_queue = asyncio.Queue()
+            self._writer_task = asyncio.create_task(self._writer_loop(self._write_queue))
+        self._write_queue.put_nowait((self._persist_generation, _dumps_cache(record)))
+
+    async def _writer_loop(self, queue: asyncio.Queue):
+        """后台写入任务：每次取出最多 PERSIST_BATCH_SIZE 条记录，合并为一次追加写入"""
+        try:
+            await self._ensure_data_dir()
+        except Exception as e:
+            logger.error(f"[ContextEnhancerV2] 创建数据目录失败: {e}")
+        stopping = False
+        while not stopping:
+            batch = [await queue.get()]
+            while len(batch) < ContextConstants.PERSIST_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            if None in batch:  # None 是停止信号，同批中的其余记录照常写入
+                batch = [item for item in batch if item is not None]
+                stopping = True
+            if not batch:
+                continue
+            # 持锁期间压缩不会截断日志；低于下限的记录已包含在最新快照中，直接丢弃
+            async with self._log_lock:
+                floor = self._persist_floor
+                payloads = [payload for generation, payload in batch if generation >= floor]
+                if payloads:
+                    try:
+                        await asyncio.to_thread(_append_bytes, self.log_path, b"".join(payloads))
+                        self._log_records_written += len(payloads)
+                    except Exception as e:
+                        logger.error(f"[ContextEnhancerV2] 写入追加日志失败: {e}")
+
+    async def _stop_writer(self):
+        """发送停止信号并等待后台写入任务把队列中的记录全部写完"""
+        task, queue = self._writer_task, self._write_queue
+        if task is None:
+            return
+        # 先摘下队列再发送停止信号：等待期间新入队的记录进入新的队列，不会排在停止信号之后而被遗漏
+        self._write_queue = None
+        self._writer_task = None
+        queue.put_nowait(None)
+        await task
+
+    def _serialize_snapshot(self) -> bytes:
+        """把内存中的全部群组序列化为快照（同步执行，期间缓存不会被其他协程修改）"""
+        serializable_data = {}
+        # 在保存前，根据配置裁剪消息列表，防止缓存文件无限增长
+        max_messages_to_save = self.config.recent_chats_count + self.config.bot_replies_count
+        # group_messages 按最近活跃顺序排列，快照保持同样的顺序，加载后 LRU 顺序不变
+        for group_id, buffers in self.group_messages.items():
+            # 各缓冲区本身已按配置条数封顶，合并的规模与最终保存的条数同阶
+            all_messages = _merge_buffers(buffers)
+
+            # 序列化：用 islice 从需要保留的位置开始，省去切片产生的中间列表
+            start = max(len(all_messages) - max_messages_to_save, 0)
+            serializable_data[group_id] = [msg.to_dict() for msg in itertools.islice(all_messages, start, None)]
+        return _dumps_cache(serializable_data)
+
+    async def _compact_persisted_cache(self):
+        """
+        压缩：把内存中的缓存原子化写成快照，并删除已被快照覆盖的追加日志。
+        持有 _log_lock 期间写入任务不会追加日志；快照写入成功后提升下限，队列中更早的记录随之作废，
+        而序列化之后才入队的记录属于新的代次，会照常写入新的日志。
+        """
+        temp_path = self.cache_path + ".tmp"
+        try:
+            await self._ensure_data_dir()
+            async with self._log_lock:
+                # 1. 一次性序列化，再在单次线程调用中写入临时文件并原子性替换
+                payload = self._serialize_snapshot()
+                self._persist_generation += 1
+                generation = self._persist_generation
+                await asyncio.to_thread(_atomic_write_bytes, self.cache_path, temp_path, payload)
+                self._persist_floor = generation
+                self._log_records_written = 0
+                logger.info(f"上下文缓存已成功原子化保存到 {self.cache_path}")
+
+                # 快照已包含全部消息，追加日志可以丢弃
+                await asyncio.to_thread(_remove_if_exists, self.log_path)
+        except Exception as e:
+            logger.error(f"[ContextEnhancerV2] 异步保存上下文缓存失败: {e}")
+        finally:
+            # 2. 确保清理临时文件：直接删除并忽略不存在的情况，省去一次 stat 且没有检查与删除之间的竞态
+            try:
+                await aio_remove(temp_path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"[ContextEnhancerV2] 清理临时缓存文件 {temp_path} 失败: {e}")
+
+    async def _replay_persist_log(self) -> bool:
+        """在快照之后重放追加日志，恢复上次未正常终止时丢失的消息；返回日志文件是否存在"""
+        capacity = {
+            "recent_chats": self.config.recent_chats_count,
+            "bot_replies": self.config.bot_replies_count,
+            "image_messages": self.config.max_images_in_context,
+        }
+        try:
+            result = await asyncio.to_thread(
+                _read_log_tail, self.log_path, capacity, ContextConstants.MAX_CACHED_GROUPS
+            )
+        except Exception as e:
+            logger.error(f"[ContextEnhancerV2] 读取追加日志失败: {e}")
+            return False
+        if result is None:
+            return False
+
+        groups, dropped, skipped = result
+        if skipped:
+            logger.warning(f"[ContextEnhancerV2] 跳过了 {skipped} 条无法解析的追加日志记录。")
+        for group_id in dropped:
+            self.group_messages.pop(group_id, None)
+        replayed = 0
+        for group_id, (cleared, records) in groups.items():
+            buffers = self.group_messages.pop(group_id, None)
+            if cleared or buffers is None:
+                buffers = self._create_new_group_buffers()
+            for msg_list in records.values():
+                for msg_data in msg_list:
+                    try:
+                        self._dispatch_loaded_message(buffers, GroupMessage.from_dict(msg_data))
+                        replayed += 1
+                    except Exception as e:
+                        logger.warning(f"[ContextEnhancerV2] 从追加日志恢复消息失败 (群 {group_id}): {e}")
+            # 移到末尾，与日志中的活跃顺序一致
+            self.group_messages[group_id] = buffers
+        logger.info(f"[ContextEnhancerV2] 从追加日志重放了 {replayed} 条消息。")
+        return True
+
+    @staticmethod
+    def _dispatch_loaded_message(buffers: "GroupMessageBuffers", msg: GroupMessage):
+        """根据消息类型和内容将恢复的消息分发到对应的 deque"""
+        if msg.message_type == ContextMessageType.BOT_REPLY:
+            buffers.bot_replies.append(msg)
+            buffers.bot_replies_index.record(msg)
+        elif msg.has_image:
+            buffers.track_nonce(buffers.image_messages, msg)
+            buffers.image_messages.append(msg)
+        else:
+            buffers.track_nonce(buffers.recent_chats, msg)
+            buffers.recent_chats.append(msg)
+            buffers.recent_chats_index.record(msg)
+
     def _load_group_messages_from_dict(
         self, data: Dict[str, list]
     ) -> Dict[str, "GroupMessageBuffers"]:
@@ -329,113 +787,180 @@ class ContextEnhancerV2(Star):
             # 为每个群组创建独立的缓冲区
             buffers = self._create_new_group_buffers()
 
-            for msg_data in msg_list:
+            for msg_data in self._select_loadable_messages(buffers, msg_list):
                 try:
-                    msg = GroupMessage.from_dict(msg_data)
-                    # 根据消息类型和内容分发到对应的 deque
-                    if msg.message_type == ContextMessageType.BOT_REPLY:
-                        buffers.bot_replies.append(msg)
-                    elif msg.has_image:
-                        buffers.image_messages.append(msg)
-                    else:
-                        buffers.recent_chats.append(msg)
+                    self._dispatch_loaded_message(buffers, GroupMessage.from_dict(msg_data))
                 except Exception as e:
                     logger.warning(f"[ContextEnhancerV2] 从字典转换并分发消息失败 (群 {group_id}): {e}")
             group_buffers_map[group_id] = buffers
         return group_buffers_map
 
+    @staticmethod
+    def _select_loadable_messages(buffers: "GroupMessageBuffers", msg_list: list) -> list:
+        """
+        倒序预选每个 deque 实际能容纳的最新消息（按时间正序返回），
+        避免为加载后立即会被 maxlen 挤出的旧消息构造 GroupMessage 对象。
+        """
+        capacity = {
+            "bot_replies": buffers.bot_replies.maxlen,
+            "image_messages": buffers.image_messages.maxlen,
+            "recent_chats": buffers.recent_chats.maxlen,
+        }
+        remaining = sum(capacity.values())
+        selected = []
+        for msg_data in reversed(msg_list):
+            if remaining <= 0:
+                break
+            if not isinstance(msg_data, dict):
+                continue
+            target = _loaded_message_target(msg_data)
+            if capacity[target] > 0:
+                capacity[target] -= 1
+                remaining -= 1
+                selected.append(msg_data)
+        selected.reverse()
+        return selected
+
     def _create_new_group_buffers(self) -> "GroupMessageBuffers":
         """创建一个新的 GroupMessageBuffers 实例，并根据配置初始化 deques"""
-        # 为每个 deque 设置独立的 maxlen，并增加一定的缓冲空间
+        # 每个 deque 的 maxlen 恰好等于上下文实际使用的条数，满时自动丢弃最旧的消息；
+        # 防重复检查使用独立的 DuplicateIndex 窗口，不依赖缓冲区的额外空间
         return GroupMessageBuffers(
-            recent_chats=deque(maxlen=self.config.recent_chats_count * self.CACHE_LOAD_BUFFER_MULTIPLIER),
-            bot_replies=deque(maxlen=self.config.bot_replies_count * self.CACHE_LOAD_BUFFER_MULTIPLIER),
-            image_messages=deque(maxlen=self.config.max_images_in_context * self.CACHE_LOAD_BUFFER_MULTIPLIER)
+            recent_chats=deque(maxlen=self.config.recent_chats_count),
+            bot_replies=deque(maxlen=self.config.bot_replies_count),
+            image_messages=deque(maxlen=self.config.max_images_in_context),
+            recent_chats_index=DuplicateIndex(self.config.duplicate_check_window_messages),
+            bot_replies_index=DuplicateIndex(self.config.duplicate_check_window_messages),
+            nonce_index={},
+            lock=Lock(),
         )
 
+    def _peek_group_buffers(self, group_id: str) -> Optional["GroupMessageBuffers"]:
+        """只读获取群聊的消息缓冲区集合，不更新活动时间、不触发清理、不创建新缓冲区"""
+        return self.group_messages.get(group_id)
+
     async def _get_or_create_group_buffers(self, group_id: str) -> "GroupMessageBuffers":
         """获取或创建群聊的消息缓冲区集合"""
-        current_dt = datetime.datetime.now()
+        now = time.monotonic()
 
         # 更新活动时间
-        self.group_last_activity[group_id] = current_dt
-
-        # 基于时间的缓存清理
-        now = time.time()
-        if now - self.last_cleanup_time > self.config.cleanup_interval_seconds:
-            await self._cleanup_inactive_groups(current_dt)
-            self.last_cleanup_time = now
-
-        if group_id not in self.group_messages:
-            async with self._global_lock:
-                # 双重检查，防止在等待锁期间其他协程已创建
-                if group_id not in self.group_messages:
-                    self.group_messages[group_id] = self._create_new_group_buffers()
-        return self.group_messages[group_id]
-
-    async def _cleanup_inactive_groups(self, current_time: datetime.datetime):
-        """清理超过配置天数未活跃的群组缓存"""
+        self.group_last_activity[group_id] = now
+
+        # 基于时间的缓存清理在后台任务中进行，消息处理路径上不再检查
+        if self._cleanup_task is None and not self._closing:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+        buffers = self.group_messages.pop(group_id, None)
+        if buffers is None:
+            # 查找、淘汰与创建之间没有 await，不会与其他协程交错，无需全局锁做双重检查
+            self._evict_least_recent_groups(ContextConstants.MAX_CACHED_GROUPS - 1)
+            buffers = self._create_new_group_buffers()
+        # 插入到末尾，使 group_messages 始终按最近活跃顺序排列（LRU）
+        self.group_messages[group_id] = buffers
+        return buffers
+
+    def _evict_least_recent_groups(self, max_groups: int):
+        """淘汰最久未活跃的群组，直到缓存的群组数不超过 max_groups"""
+        while len(self.group_messages) > max_groups:
+            # 字典保持插入顺序，首个键即最久未访问的群组
+            evicted_group_id = next(iter(self.group_messages))
+            self.group_messages.pop(evicted_group_id, None)
+            self.group_last_activity.pop(evicted_group_id, None)
+            # 写入清空标记，避免重放追加日志时恢复已淘汰的群组
+            self._enqueue_persist({"g": evicted_group_id, "clear": True})
+            logger.debug(f"[ContextEnhancerV2] 缓存群组数达到上限，已淘汰最久未活跃的群组 {evicted_group_id}")
+
+    async def _cleanup_loop(self):
+        """后台任务：每隔 cleanup_interval_seconds 清理一次不活跃群组，并把追加日志压缩进快照"""
+        while True:
+            await asyncio.sleep(self.config.cleanup_interval_seconds)
+            try:
+                await self._cleanup_inactive_groups(time.monotonic())
+            except Exception as e:
+                logger.error(f"[ContextEnhancerV2] 定时清理不活跃群组失败: {e}")
+            # 定期压缩：日志长度不超过一个清理周期内写入的记录数，崩溃后重放的量也随之有界
+            if self._log_records_written:
+                # 屏蔽取消：terminate 取消本任务时，进行中的压缩仍会持锁写完并清理临时文件，
+                # 否则工作线程中的写入会在锁释放后继续，与 terminate 的快照交错或用旧快照覆盖新快照
+                await asyncio.shield(self._compact_persisted_cache())
+
+    async def _cleanup_inactive_groups(self, current_time: float):
+        """清理超过配置天数未活跃的群组缓存（current_time 为 time.monotonic() 时间）"""
         logger.info("开始清理不活跃群组...")
-        inactive_threshold = datetime.timedelta(
-            days=self.config.inactive_cleanup_days
-        )
-        inactive_groups = []
+        cutoff = current_time - self._inactive_cleanup_seconds
 
-        # 这个循环是安全的，因为它只读取 self.group_last_activity
-        for group_id, last_activity in list(self.group_last_activity.items()):
-            if current_time - last_activity > inactive_threshold:
+        # 单次遍历：同时得到保留的活动记录和需要清理的群组，再整体替换活动字典
+        # 遍历期间没有 await，因此无需先复制 items()
+        active_groups = {}
+        inactive_groups = []
+        for group_id, last_activity in self.group_last_activity.items():
+            if last_activity < cutoff:
                 inactive_groups.append(group_id)
+            else:
+                active_groups[group_id] = last_activity
 
         if inactive_groups:
             logger.info(f"准备清理 {len(inactive_groups)} 个不活跃的群组上下文缓存...")
-            async with self._global_lock:
-                for group_id in inactive_groups:
-                    self.group_messages.pop(group_id, None)
-                    self.group_last_activity.pop(group_id, None)
-                    self.group_locks.pop(group_id, None)
+            # 整个清理过程没有 await，无需加锁，也不会阻塞其他群组创建缓冲区
+            self.group_last_activity = active_groups
+            for group_id in inactive_groups:
+                self.group_messages.pop(group_id, None)
+                self._enqueue_persist({"g": group_id, "clear": True})
             logger.info(f"不活跃群组上下文缓存清理完毕，共清理 {len(inactive_groups)} 个。")
         else:
             logger.info("没有不活跃的群组需要清理。")
 
     def is_chat_enabled(self, event: AstrMessageEvent) -> bool:
         """检查当前聊天是否启用增强功能"""
-        if event.get_message_type() == MessageType.FRIEND_MESSAGE:
+        return self._is_chat_enabled_for(event.get_message_type(), event.get_group_id())
+
+    def _is_chat_enabled_for(self, message_type, group_id: Optional[str]) -> bool:
+        """is_chat_enabled 的实现，供已取得消息类型和群号的调用方直接使用"""
+        if message_type is MessageType.FRIEND_MESSAGE:  # 枚举成员是单例，按身份比较
             return True  # 简化版本默认启用私聊
-        
-        group_id = event.get_group_id()
-        logger.debug(f"[ContextEnhancerV2] 群聊启用检查: 群ID={group_id}, 启用列表={self.config.enabled_groups}")
-        
+
+        # 每条群消息都会经过这里，仅在 DEBUG 级别开启时才格式化整个启用列表
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[ContextEnhancerV2] 群聊启用检查: 群ID={group_id}, 启用列表={self.config.enabled_groups}")
+
         # 如果启用列表为空，则对所有群组生效；否则，检查 group_id 是否在列表中
         return not self.config.enabled_groups or group_id in self.config.enabled_groups
 
     @event_filter.platform_adapter_type(event_filter.PlatformAdapterType.ALL)
     async def on_message(self, event: AstrMessageEvent):
         """监听所有消息，进行分类和存储"""
+        if self._closing:
+            return
+        # 首个事件到达时若尚未加载持久化缓存，先等待加载完成，避免加载结果覆盖新收集的消息
+        if not self._loaded:
+            await self._async_init()
         start_time = time.monotonic()
+        # 每个事件只查询一次消息类型和群号，之后以局部变量向下传递
         group_id = event.get_group_id()
-        if event.get_message_type() == MessageType.GROUP_MESSAGE and not group_id:
+        message_type = event.get_message_type()
+        if message_type is MessageType.GROUP_MESSAGE and not group_id:
             logger.warning("[ContextEnhancerV2] 事件缺少 group_id，无法处理。")
             return
         
         try:
-            if not self.is_chat_enabled(event):
+            if not self._is_chat_enabled_for(message_type, group_id):
                 return
 
             # 检查是否是 reset 命令
             message_text = (event.message_str or "").strip()
-            if message_text.lower() in ["reset", "new"]:
+            if message_text.lower() in ContextConstants.RESET_COMMANDS:
                 await self.handle_clear_context_command(event)
                 return
 
-            if event.get_message_type() == MessageType.GROUP_MESSAGE:
-                await self._handle_group_message(event)
+            if message_type is MessageType.GROUP_MESSAGE:
+                await self._handle_group_message(event, group_id)
 
         except Exception as e:
-            logger.error(f"[ContextEnhancerV2] 处理消息时发生错误: {e}")
-            logger.error(f"[ContextEnhancerV2] {traceback.format_exc()}")
+            logger.exception(f"[ContextEnhancerV2] 处理消息时发生错误: {e}")
         finally:
-            duration = (time.monotonic() - start_time) * 1000
-            logger.debug(f"[Profiler] on_message for group {group_id} took: {duration:.2f} ms")
+            if logger.isEnabledFor(logging.DEBUG):
+                duration = (time.monotonic() - start_time) * 1000
+                logger.debug(f"[Profiler] on_message for group {group_id} took: {duration:.2f} ms")
 
     def _extract_user_info_from_event(self, event: AstrMessageEvent) -> tuple[str, str]:
         """
@@ -474,16 +999,17 @@ class ContextEnhancerV2(Star):
         if not self.config.enable_image_caption or not self.image_caption_utils:
             return ["图片"] * len(images)
 
-        tasks = []
-        for image_url in images:
-            if image_url:
-                task = self.image_caption_utils.generate_image_caption(
-                    image_url,
-                    timeout=self.config.image_caption_timeout,
-                    provider_id=self.config.image_caption_provider_id or None,
-                    custom_prompt=self.config.image_caption_prompt,
-                )
-                tasks.append(task)
+        # images 已是 _scan_components 解析好的非空 URL，无需再逐个读取组件属性
+        provider_id = self.config.image_caption_provider_id or None
+        tasks = [
+            self.image_caption_utils.generate_image_caption(
+                image_url,
+                timeout=self.config.image_caption_timeout,
+                provider_id=provider_id,
+                custom_prompt=self.config.image_caption_prompt,
+            )
+            for image_url in images
+        ]
 
         captions = []
         if tasks:
@@ -497,31 +1023,80 @@ class ContextEnhancerV2(Star):
         
         return captions
 
-    async def _create_group_message_from_event(self, event: AstrMessageEvent, message_type: str) -> GroupMessage:
-        """从事件创建 GroupMessage 实例，并在检测到图片时异步获取描述"""
-        text_content_parts = []
-        images = []
-        
+    @staticmethod
+    def _get_raw_components(event: AstrMessageEvent) -> list:
         message_obj = getattr(event, 'message_obj', None)
-        raw_components = message_obj.message if message_obj and hasattr(message_obj, 'message') else []
+        return message_obj.message if message_obj and hasattr(message_obj, 'message') else []
 
-        for comp in raw_components:
+    def _scan_components(self, event: AstrMessageEvent) -> ComponentScan:
+        """一次遍历消息组件，同时提取文本片段、图片URL和被@的ID，结果缓存在事件上"""
+        cached = getattr(event, '_context_enhancer_scan', None)
+        if isinstance(cached, ComponentScan):
+            return cached
+
+        scan = ComponentScan(text_parts=[], images=[], at_targets=set())
+        for comp in self._get_raw_components(event):
             if isinstance(comp, Plain):
-                text_content_parts.append(comp.text)
+                scan.text_parts.append(comp.text)
             elif isinstance(comp, At):
-                text_content_parts.append(f"@{comp.qq}")
+                at_target = str(comp.qq)
+                scan.at_targets.add(at_target)
+                scan.text_parts.append(f"@{at_target}")
             elif isinstance(comp, Face):
-                text_content_parts.append(f"[表情]")
+                scan.text_parts.append(f"[表情]")
             elif isinstance(comp, Reply):
-                text_content_parts.append(f"[引用了 {comp.sender_nickname} 的消息]")
+                scan.text_parts.append(f"[引用了 {comp.sender_nickname} 的消息]")
             elif isinstance(comp, Image):
                 image_url = getattr(comp, "url", None) or getattr(comp, "file", None)
                 if image_url:
-                    images.append(image_url)
+                    scan.images.append(image_url)
+
+        setattr(event, '_context_enhancer_scan', scan)
+        return scan
 
-        if images:
-            captions = await self._get_image_captions(images)
-            text_content_parts.append(f"[Image: {'; '.join(captions)}]")
+    async def _generate_image_captions(self, msg: GroupMessage):
+        """为消息中的图片生成描述并写回 msg.image_captions，已有描述的消息直接跳过"""
+        if not msg.images or msg.image_captions:
+            return
+        # 并发的 on_llm_request 可能选中同一条消息：已有进行中的任务时直接等待它，避免重复生成描述
+        if msg.caption_task is None:
+            msg.caption_task = asyncio.ensure_future(self._run_image_caption(msg))
+        # shield：某个等待方被取消时不应连带取消其他请求共享的生成任务
+        await asyncio.shield(msg.caption_task)
+
+    async def _run_image_caption(self, msg: GroupMessage):
+        """实际生成图片描述；结束后清除进行中标记，失败时后续请求可以重试"""
+        try:
+            async with self._caption_semaphore:
+                msg.image_captions = await self._get_image_captions(msg.images)
+                msg.invalidate_dict_cache()
+        finally:
+            msg.caption_task = None
+
+    def _collect_uncaptioned_messages(self, sorted_messages: list[GroupMessage]) -> list[GroupMessage]:
+        """找出将进入上下文、但尚未生成图片描述的消息（筛选条件与 _extract_messages_for_context 一致）"""
+        pending = []
+        selected = 0
+        for msg in reversed(sorted_messages):
+            if selected >= self.config.recent_chats_count:
+                break
+            if msg.message_type == ContextMessageType.BOT_REPLY or not (msg.text_content or msg.has_image):
+                continue
+            selected += 1
+            if msg.has_image and not msg.image_captions:
+                pending.append(msg)
+        return pending
+
+    def _create_group_message_from_event(
+        self, event: AstrMessageEvent, message_type: str, group_id: Optional[str] = None
+    ) -> GroupMessage:
+        """从事件创建 GroupMessage 实例。图片描述延迟到消息真正进入 LLM 上下文时才生成"""
+        scan = self._scan_components(event)
+        text_content_parts = scan.text_parts
+        images = list(scan.images)
+
+        message_obj = getattr(event, 'message_obj', None)
+        raw_components = self._get_raw_components(event)
 
         final_sender_name, final_sender_id = self._extract_user_info_from_event(event)
 
@@ -529,18 +1104,17 @@ class ContextEnhancerV2(Star):
             message_type=message_type,
             sender_id=final_sender_id,
             sender_name=final_sender_name,
-            group_id=event.get_group_id(),
+            group_id=group_id if group_id is not None else event.get_group_id(),
             text_content="".join(text_content_parts).strip(),
             images=images,
             message_id=getattr(event, 'id', None) or (message_obj and getattr(message_obj, 'id', None)),
-            nonce=getattr(event, '_context_enhancer_nonce', None),
             raw_components=raw_components
         )
 
-    async def _handle_group_message(self, event: AstrMessageEvent):
+    async def _handle_group_message(self, event: AstrMessageEvent, group_id: Optional[str] = None):
         """处理群聊消息"""
-        # 现在 create 方法是 async 的，需要 await
-        group_msg = await self._create_group_message_from_event(event, "")  # 临时创建以检查内容
+        # 图片描述已延迟到 on_llm_request，创建消息不涉及 I/O，同步调用即可
+        group_msg = self._create_group_message_from_event(event, "", group_id)  # 临时创建以检查内容
         if not group_msg.text_content and not group_msg.has_image: # 检查 has_image 以防万一
             logger.debug("[ContextEnhancerV2] 消息为空（无文本无图片），跳过处理。")
             return
@@ -551,67 +1125,69 @@ class ContextEnhancerV2(Star):
 
             message_type = self._classify_message(event)
             group_msg.message_type = message_type # 更新消息类型
+            if message_type == ContextMessageType.LLM_TRIGGERED:
+                # nonce 由 _classify_message 附加到事件上，必须在分类之后再写入消息，否则 nonce_index 永远为空
+                group_msg.nonce = getattr(event, '_context_enhancer_nonce', None)
 
             # 获取或创建该群组的缓冲区集合
             buffers = await self._get_or_create_group_buffers(group_msg.group_id)
-            lock = self._get_or_create_lock(group_msg.group_id)
 
-            async with lock:
+            async with buffers.lock:
                 # 根据消息类型和内容，将其放入对应的 deque
-                target_deque = None
                 if message_type == ContextMessageType.BOT_REPLY:
-                    target_deque = buffers.bot_replies
+                    target_deque, target_index = buffers.bot_replies, buffers.bot_replies_index
                 # 图片消息现在作为普通聊天处理，因为内容已是文本
                 else: # NORMAL_CHAT or LLM_TRIGGERED
-                    target_deque = buffers.recent_chats
+                    target_deque, target_index = buffers.recent_chats, buffers.recent_chats_index
 
                 # 🚨 防重复机制：检查是否已存在相同消息
-                if not self._is_duplicate_message(target_deque, group_msg):
+                if not self._is_duplicate_message(target_index, group_msg):
+                    buffers.track_nonce(target_deque, group_msg)
                     target_deque.append(group_msg)
-                    logger.debug(
-                        f"收集群聊消息 [{message_type}] (群组: {group_msg.group_id}): {group_msg.sender_name} - {group_msg.text_content[:50]}..."
-                    )
-                else:
+                    target_index.record(group_msg)
+                    self._enqueue_persist({"g": group_msg.group_id, "m": group_msg.to_dict()})
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(
+                            f"收集群聊消息 [{message_type}] (群组: {group_msg.group_id}): {group_msg.sender_name} - {group_msg.text_content[:50]}..."
+                        )
+                elif logger.isEnabledFor(logging.DEBUG):
                     logger.debug(
                         f"[ContextEnhancerV2] 跳过重复消息: {group_msg.sender_name} - {group_msg.text_content[:30]}..."
                     )
 
         except Exception as e:
-            logger.error(f"[ContextEnhancerV2] 处理群聊消息时发生错误: {e}")
+            logger.exception(f"[ContextEnhancerV2] 处理群聊消息时发生错误: {e}")
 
-    def _is_duplicate_message(self, target_deque: deque, new_msg: GroupMessage) -> bool:
-        """检查消息是否已存在于目标缓冲区（防重复）"""
+    def _is_duplicate_message(self, target_index: DuplicateIndex, new_msg: GroupMessage) -> bool:
+        """检查消息是否已存在于目标缓冲区的最近N条消息中（防重复）"""
         # 如果新消息包含图片，则不视为重复，以确保图片总能被处理
         if new_msg.has_image:
             return False
-            
-        # 检查最近N条消息即可，避免性能问题
-        start_index = max(0, len(target_deque) - self.config.duplicate_check_window_messages)
-        recent_messages = list(itertools.islice(target_deque, start_index, len(target_deque)))
-
-        for existing_msg in recent_messages:
-            # 重复判断条件：
-            # 1. 相同发送者
-            # 2. 相同文本内容
-            # 3. 时间差在指定窗口内
-            if (
-                existing_msg.sender_id == new_msg.sender_id and
-                existing_msg.text_content == new_msg.text_content and
-                abs((new_msg.timestamp - existing_msg.timestamp).total_seconds()) < self.config.duplicate_check_time_seconds
-            ):
-                return True
-
-        return False
+
+        # 重复判断条件：
+        # 1. 相同发送者
+        # 2. 相同文本内容
+        # 3. 时间差在指定窗口内
+        last_seen = target_index.get_last_seen(new_msg)
+        return (
+            last_seen is not None and
+            abs(new_msg.timestamp - last_seen) < self.config.duplicate_check_time_seconds
+        )
 
     def _is_bot_message(self, event: AstrMessageEvent) -> bool:
-        """检查是否是机器人自己发送的消息"""
+        """检查是否是机器人自己发送的消息（结果缓存在事件上，同一事件只计算一次）"""
+        cached = getattr(event, '_context_enhancer_is_bot', None)
+        if isinstance(cached, bool):
+            return cached
         try:
             # 获取机器人自身ID
             bot_id = event.get_self_id()
             sender_id = event.get_sender_id()
 
             # 如果发送者ID等于机器人ID，则是机器人自己的消息
-            return bool(bot_id and sender_id and str(sender_id) == str(bot_id))
+            is_bot = bool(bot_id and sender_id and str(sender_id) == str(bot_id))
+            setattr(event, '_context_enhancer_is_bot', is_bot)
+            return is_bot
         except (AttributeError, KeyError) as e:
             logger.warning(f"[ContextEnhancerV2] 检查机器人消息时出错（可能是不支持的事件类型或数据结构）: {e}")
             return False
@@ -631,7 +1207,7 @@ class ContextEnhancerV2(Star):
         # 1. 检查是否为用户直接触发
         if self._is_directly_triggered(event):
             # 附加一个唯一标识符，用于后续精确匹配
-            setattr(event, '_context_enhancer_nonce', uuid.uuid4().hex)
+            setattr(event, '_context_enhancer_nonce', f"{self._nonce_prefix}-{next(self._nonce_counter)}")
             return ContextMessageType.LLM_TRIGGERED
 
         # 2. 检查是否为间接触发（例如被 wakepro 唤醒）
@@ -649,33 +1225,46 @@ class ContextEnhancerV2(Star):
         if not bot_id:
             return False
 
-        # 检查消息组件
-        if event.message_obj and event.message_obj.message:
-            for comp in event.message_obj.message:
-                if isinstance(comp, At) and (
-                    str(comp.qq) == str(bot_id) or comp.qq == "all"
-                ):
-                    return True
-        
-        # 检查纯文本
-        message_text = event.message_str or ""
-        # 使用正则表达式确保 @<bot_id> 是一个独立的词
-        pattern = rf'(^|\s)@{re.escape(str(bot_id))}($|\s)'
-        if re.search(pattern, message_text):
+        bot_id = str(bot_id)
+
+        # 检查消息组件（复用单次遍历的结果）
+        at_targets = self._scan_components(event).at_targets
+        if bot_id in at_targets or "all" in at_targets:
             return True
 
-        return False
+        # 检查纯文本，不含 '@' 时无需进入正则
+        message_text = event.message_str or ""
+        if "@" not in message_text:
+            return False
+        return self._get_at_pattern(bot_id).search(message_text) is not None
+
+    def _get_at_pattern(self, bot_id: str) -> re.Pattern:
+        """获取（并缓存）匹配独立 @<bot_id> 的预编译正则"""
+        pattern = self._at_pattern_cache.get(bot_id)
+        if pattern is None:
+            # 使用正则表达式确保 @<bot_id> 是一个独立的词
+            pattern = re.compile(rf'(^|\s)@{re.escape(bot_id)}($|\s)')
+            self._at_pattern_cache[bot_id] = pattern
+        return pattern
 
     def _is_keyword_triggered(self, event: AstrMessageEvent) -> bool:
         """检查消息是否通过命令前缀触发"""
-        message_text = (event.message_str or "").lower().strip()
+        message_text = (event.message_str or "").lstrip()
         if not message_text:
             return False
 
-        return any(
-            message_text.startswith(prefix)
-            for prefix in self.config.command_prefixes
-        )
+        # 快速路径：首字符不是任何前缀的首字符时直接返回，无需对整条消息 lower()
+        firstchars = self._command_prefix_firstchars
+        if firstchars is not None:
+            first_char = message_text[0].lower()[0] if self._command_prefixes_cased else message_text[0]
+            if first_char not in firstchars:
+                return False
+
+        if self._command_prefixes_cased:
+            message_text = message_text.lower()
+
+        # str.startswith 接受元组，在 C 层一次完成所有前缀的匹配
+        return message_text.startswith(self.config.command_prefixes)
 
     def _is_directly_triggered(self, event: AstrMessageEvent) -> bool:
         """
@@ -700,57 +1289,69 @@ class ContextEnhancerV2(Star):
         此方法作为总入口，协调上下文的构建和注入流程。
         """
         start_time = time.monotonic()
+        # 日志级别每个请求只查询一次，生产环境下跳过各 Profiler 日志的字符串格式化
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
         group_id = event.get_group_id()
-        if event.get_message_type() == MessageType.GROUP_MESSAGE and not group_id:
+        message_type = event.get_message_type()
+        if message_type is MessageType.GROUP_MESSAGE and not group_id:
             logger.warning(f"[ContextEnhancerV2] LLM 请求事件缺少 group_id，无法增强上下文。")
             return
             
         try:
             # 1. 检查是否需要增强
-            if not self._should_enhance_context(event, request):
+            if not self._should_enhance_context(request, message_type, group_id):
                 return
 
-            # 2. 获取群聊历史记录
-            group_id = event.get_group_id()
-            buffers = await self._get_or_create_group_buffers(group_id)
-            if not any([buffers.recent_chats, buffers.bot_replies, buffers.image_messages]):
+            if not self._loaded:
+                await self._async_init()
+
+            # 2. 获取群聊历史记录（只读路径，不产生活动记录等副作用）
+            buffers = self._peek_group_buffers(group_id)
+            if not buffers or not (buffers.recent_chats or buffers.bot_replies or buffers.image_messages):
                 logger.debug("[ContextEnhancerV2] 所有消息缓冲区都为空，跳过增强")
                 return
 
             # 3. 确定场景（被动回复 vs 主动发言）
-            lock = self._get_or_create_lock(group_id)
-            async with lock:
+            async with buffers.lock:
                 # 合并所有消息用于查找触发消息
                 collect_start = time.monotonic()
-                # deques are already sorted by timestamp implicitly
-                all_messages = list(heapq.merge(buffers.recent_chats, buffers.bot_replies, buffers.image_messages, key=lambda x: x.timestamp))
-                logger.debug(f"[ContextEnhancerV2] [Profiler] Merging messages from deques took: {(time.monotonic() - collect_start) * 1000:.2f} ms")
+                all_messages = _merge_buffers(buffers)
+                if debug_enabled:
+                    logger.debug(f"[ContextEnhancerV2] [Profiler] Merging messages from deques took: {(time.monotonic() - collect_start) * 1000:.2f} ms")
 
-                triggering_message, scene = self._find_triggering_message_from_event(all_messages, event)
+                triggering_message, scene = self._find_triggering_message_from_event(buffers, event)
 
-                # 4. 构建上下文增强内容
-                build_start = time.monotonic()
-                context_enhancement, image_urls_for_context = self._build_context_enhancement(
-                    all_messages, request.prompt, triggering_message, scene, event
-                )
+            # 4. 只为即将进入上下文的图片消息生成描述，在锁外等待以免阻塞消息收集
+            pending_messages = self._collect_uncaptioned_messages(all_messages)
+            if pending_messages:
+                await asyncio.gather(*(self._generate_image_captions(msg) for msg in pending_messages))
+
+            # 5. 构建上下文增强内容
+            build_start = time.monotonic()
+            context_enhancement, image_urls_for_context = self._build_context_enhancement(
+                all_messages, request.prompt, triggering_message, scene, event
+            )
+            if debug_enabled:
                 logger.debug(f"[ContextEnhancerV2] [Profiler] _build_context_enhancement took: {(time.monotonic() - build_start) * 1000:.2f} ms")
 
-            # 5. 将上下文注入到请求中
+            # 6. 将上下文注入到请求中
             self._inject_context_into_request(request, context_enhancement, image_urls_for_context)
 
         except Exception as e:
-            logger.error(f"[ContextEnhancerV2] 上下文增强时发生错误: {e}")
-            logger.error(f"[ContextEnhancerV2] {traceback.format_exc()}")
+            logger.exception(f"[ContextEnhancerV2] 上下文增强时发生错误: {e}")
         finally:
-            duration = (time.monotonic() - start_time) * 1000
-            logger.debug(f"[Profiler] on_llm_request for group {group_id} took: {duration:.2f} ms")
+            if debug_enabled:
+                duration = (time.monotonic() - start_time) * 1000
+                logger.debug(f"[Profiler] on_llm_request for group {group_id} took: {duration:.2f} ms")
 
-    def _should_enhance_context(self, event: AstrMessageEvent, request: ProviderRequest) -> bool:
+    def _should_enhance_context(self, request: ProviderRequest, message_type, group_id: Optional[str]) -> bool:
         """检查是否应执行上下文增强"""
+        # 已增强标志是 O(1) 的属性检查，无需在 prompt 中搜索标记文本；
+        # 按开销从低到高排列条件，让非群聊请求不必进入启用检查
         return (
             not hasattr(request, '_context_enhanced') and
-            self.is_chat_enabled(event) and
-            event.get_message_type() == MessageType.GROUP_MESSAGE
+            message_type is MessageType.GROUP_MESSAGE and
+            self._is_chat_enabled_for(message_type, group_id)
         )
 
     def _extract_messages_for_context(self, sorted_messages: list[GroupMessage]) -> dict:
@@ -758,27 +1359,25 @@ class ContextEnhancerV2(Star):
         max_chats = self.config.recent_chats_count
         max_bot_replies = self.config.bot_replies_count
 
-        # 使用列表推导式和 islice 高效筛选和截取
-        bot_replies = [
-            f"你回复了: {msg.text_content}"
-            for msg in itertools.islice(
-                (m for m in reversed(sorted_messages) if m.message_type == ContextMessageType.BOT_REPLY),
-                max_bot_replies
-            )
-        ]
-        
-        recent_chats = [
-            f"{msg.sender_name}: {msg.text_content}"
-            for msg in itertools.islice(
-                (m for m in reversed(sorted_messages) if m.message_type != ContextMessageType.BOT_REPLY and m.text_content),
-                max_chats
-            )
-        ]
+        # 单次倒序遍历：用 appendleft 直接得到正序结果，两类消息都取满后立即退出
+        recent_chats = deque(maxlen=max_chats)
+        bot_replies = deque(maxlen=max_bot_replies)
+        # 循环内频繁使用的属性与方法提前绑定到局部变量
+        bot_reply_type = ContextMessageType.BOT_REPLY
+        add_chat, add_bot_reply = recent_chats.appendleft, bot_replies.appendleft
+        for msg in reversed(sorted_messages):
+            if msg.message_type == bot_reply_type:
+                if len(bot_replies) < max_bot_replies:
+                    add_bot_reply(f"你回复了: {msg.text_content}")
+            elif (msg.text_content or msg.has_image) and len(recent_chats) < max_chats:
+                add_chat(f"{msg.sender_name}: {msg.display_text}")
+
+            if len(recent_chats) == max_chats and len(bot_replies) == max_bot_replies:
+                break
 
-        # 反转以恢复时序
         return {
-            "recent_chats": list(reversed(recent_chats)),
-            "bot_replies": list(reversed(bot_replies)),
+            "recent_chats": list(recent_chats),
+            "bot_replies": list(bot_replies),
         }
 
     def _build_context_enhancement(
@@ -795,32 +1394,38 @@ class ContextEnhancerV2(Star):
         """
         extracted_data = self._extract_messages_for_context(sorted_messages)
 
-        # 提取图片URL
-        image_urls = []
-        for msg in sorted_messages:
-            if msg.images:
-                image_urls.extend(msg.images)
-        
-        # 限制图片数量
-        if len(image_urls) > self.config.max_images_in_context:
-            image_urls = image_urls[-self.config.max_images_in_context:]
-
-
-        # 构建历史聊天记录部分
-        history_parts = [ContextConstants.PROMPT_HEADER]
-        history_parts.extend(self._format_recent_chats_section(extracted_data["recent_chats"]))
-        history_parts.extend(self._format_bot_replies_section(extracted_data["bot_replies"]))
-        context_str = "\n".join(part for part in history_parts if part)
-
-        # 根据场景选择并格式化指令
-        instruction_prompt = self._format_situation_instruction(
+        # 从最新的消息开始倒序提取图片URL（用 set 去重），达到数量上限后立即停止，无需复制整个列表
+        seen_urls = set()
+        image_urls = list(itertools.islice(
+            (
+                url
+                for msg in reversed(sorted_messages)
+                for url in reversed(msg.images)
+                if url not in seen_urls and not seen_urls.add(url)
+            ),
+            self.config.max_images_in_context
+        ))
+        image_urls.reverse()
+
+        # 构建历史聊天记录部分，各段只在有内容时才加入标题
+        parts = [ContextConstants.PROMPT_HEADER]
+        recent_chats = extracted_data["recent_chats"]
+        if recent_chats:
+            parts.append(ContextConstants.RECENT_CHATS_HEADER)
+            parts.extend(recent_chats)
+        bot_replies = extracted_data["bot_replies"]
+        if bot_replies:
+            parts.append(ContextConstants.BOT_REPLIES_HEADER)
+            parts.extend(bot_replies)
+
+        # 根据场景选择并格式化指令，与历史记录之间空一行
+        parts.append("")
+        parts.append(self._format_situation_instruction(
             original_prompt, triggering_message, scene, event
-        )
+        ))
 
-        # 组合成最终的增强内容
-        final_enhancement = f"{context_str}\n\n{instruction_prompt}"
-        
-        return final_enhancement, image_urls
+        # 一次 join 组合成最终的增强内容
+        return "\n".join(parts), image_urls
 
     def _inject_context_into_request(
         self, request: ProviderRequest, context_enhancement: str, image_urls: list[str]
@@ -835,41 +1440,33 @@ class ContextEnhancerV2(Star):
         if image_urls:
             if not hasattr(request, 'image_urls') or request.image_urls is None:
                 request.image_urls = []
-            request.image_urls.extend(image_urls)
-            logger.debug(f"[ContextEnhancerV2] 向请求中追加了 {len(image_urls)} 张图片URL。")
+            # 单次遍历合并，跳过请求中已存在的图片，避免同一张图片被重复发送
+            existing_urls = set(request.image_urls)
+            new_urls = [url for url in image_urls if url not in existing_urls]
+            request.image_urls.extend(new_urls)
+            logger.debug(f"[ContextEnhancerV2] 向请求中追加了 {len(new_urls)} 张图片URL。")
 
-    def _find_triggering_message_from_event(self, sorted_messages: list[GroupMessage], llm_request_event: AstrMessageEvent) -> tuple[Optional[GroupMessage], str]:
+    def _find_triggering_message_from_event(self, buffers: "GroupMessageBuffers", llm_request_event: AstrMessageEvent) -> tuple[Optional[GroupMessage], str]:
         """
-        在 on_llm_request 事件中，从已排序的合并消息列表中根据 nonce 精确查找触发 LLM 调用的消息，并判断场景。
+        在 on_llm_request 事件中，通过群组缓冲区的 nonce 索引精确查找触发 LLM 调用的消息，并判断场景。
         """
         nonce = getattr(llm_request_event, '_context_enhancer_nonce', None)
 
         if not nonce:
-            logger.debug(f"[ContextEnhancerV2] 事件中未找到 nonce (群组: {llm_request_event.get_group_id()})，判定为'主动发言'")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"[ContextEnhancerV2] 事件中未找到 nonce (群组: {llm_request_event.get_group_id()})，判定为'主动发言'")
             return None, "主动发言"
 
-        # 使用 next() 和生成器表达式更高效地查找
-        trigger_message = next((msg for msg in reversed(sorted_messages) if msg.nonce == nonce), None)
+        trigger_message = buffers.nonce_index.get(nonce)
 
         if trigger_message:
-            logger.debug(f"通过 nonce 成功匹配到触发消息 (群组: {llm_request_event.get_group_id()})，判定为'被动回复'")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"通过 nonce 成功匹配到触发消息 (群组: {llm_request_event.get_group_id()})，判定为'被动回复'")
         else:
             logger.warning(f"持有 nonce 但在缓冲区中未找到匹配的触发消息 (群组: {llm_request_event.get_group_id()})。仍判定为'被动回复'场景。")
             
         return trigger_message, "被动回复"
 
-    def _format_recent_chats_section(self, recent_chats: list) -> list:
-        """格式化最近的聊天记录部分"""
-        if not recent_chats:
-            return []
-        return [ContextConstants.RECENT_CHATS_HEADER] + recent_chats
-
-    def _format_bot_replies_section(self, bot_replies: list) -> list:
-        """格式化机器人回复部分"""
-        if not bot_replies:
-            return []
-        return [ContextConstants.BOT_REPLIES_HEADER] + bot_replies
-
     def _format_situation_instruction(
         self,
         original_prompt: str,
@@ -880,8 +1477,6 @@ class ContextEnhancerV2(Star):
         """根据场景格式化指令性提示词"""
         if scenario == "被动回复":
             # 修复 #2: 即使 triggering_message 为 None，也使用被动回复模板
-            instruction = self.config.passive_reply_instruction
-
             # 优先从 triggering_message 获取用户信息，如果为空则从当前事件获取
             if triggering_message:
                 sender_name = triggering_message.sender_name
@@ -890,52 +1485,71 @@ class ContextEnhancerV2(Star):
                 # 使用统一的用户信息提取方法
                 sender_name, sender_id = self._extract_user_info_from_event(event)
 
-            return instruction.format(
+            return self._render_passive_instruction(
                 sender_name=sender_name,
                 sender_id=sender_id,
                 original_prompt=original_prompt,
             )
         else:
             # 默认为主动发言
-            instruction = self.config.active_speech_instruction
-            return instruction.format(
+            return self._render_active_instruction(
                 original_prompt=original_prompt
             )
 
     @event_filter.on_llm_response(priority=100)
     async def on_llm_response(self, event: AstrMessageEvent, resp):
         """记录机器人的回复内容"""
-        try:
-            if event.get_message_type() == MessageType.GROUP_MESSAGE:
-                group_id = event.get_group_id()
-
-                # 获取回复文本
-                response_text = ""
-                if hasattr(resp, "completion_text"):
-                    response_text = resp.completion_text
-                elif hasattr(resp, "text"):
-                    response_text = resp.text
-                else:
-                    response_text = str(resp)
-
-                # 创建机器人回复记录
-                bot_reply = GroupMessage(
-                    message_type=ContextMessageType.BOT_REPLY,
-                    sender_id=event.get_self_id(),
-                    sender_name=self.raw_config.get("name", "助手"),
-                    group_id=group_id,
-                    text_content=response_text[:1000]
-                )
+        # 类型判断与文本提取不涉及 I/O，放在 try 之外，避免掩盖其中的编程错误
+        if self._closing or event.get_message_type() is not MessageType.GROUP_MESSAGE:
+            return
+        group_id = event.get_group_id()
 
-                buffers = await self._get_or_create_group_buffers(group_id)
-                lock = self._get_or_create_lock(group_id)
-                async with lock:
-                    buffers.bot_replies.append(bot_reply)
+        # 获取回复文本：getattr 带默认值，属性缺失时不会经历 hasattr 内部的异常处理
+        response_text = getattr(resp, "completion_text", None)
+        if response_text is None:
+            response_text = getattr(resp, "text", None)
+        if response_text is None:
+            if not isinstance(resp, str):
+                # 没有文本字段的响应（如纯工具调用）不记录：既省去对整个响应对象做可能很昂贵的 str()，
+                # 也避免把对象的表示形式当作机器人回复写入上下文
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"[ContextEnhancerV2] LLM 响应中没有文本内容，跳过记录 (类型: {type(resp).__name__})")
+                return
+            response_text = resp
+        # 只截断一次，记录与日志共用同一个字符串；与 on_message 收集的文本一样去除首尾空白，回显才能命中查重
+        response_text = response_text[:1000].strip()
+        if not response_text:
+            # 工具调用轮次的 completion_text 是空字符串而不是 None，同样不记录
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[ContextEnhancerV2] LLM 响应文本为空，跳过记录")
+            return
 
-                logger.debug(f"[ContextEnhancerV2] 记录机器人回复: {response_text[:50]}...")
+        try:
+            if not self._loaded:
+                await self._async_init()
+
+            # 创建机器人回复记录
+            bot_reply = GroupMessage(
+                message_type=ContextMessageType.BOT_REPLY,
+                sender_id=event.get_self_id(),
+                sender_name=self._bot_name,
+                group_id=group_id,
+                text_content=response_text
+            )
 
+            buffers = await self._get_or_create_group_buffers(group_id)
+            # 追加与登记之间没有 await，不会与持锁的多步操作交错，无需获取群组锁
+            # LLM 的每次回复都是真实发出的消息，内容相同也要保留，这里不做查重
+            buffers.bot_replies.append(bot_reply)
+            # 登记到查重索引，平台随后回显的同一条机器人消息会在 on_message 中被识别为重复
+            buffers.bot_replies_index.record(bot_reply)
+            self._enqueue_persist({"g": group_id, "m": bot_reply.to_dict()})
         except Exception as e:
-            logger.error(f"[ContextEnhancerV2] 记录机器人回复时发生错误: {e}")
+            logger.exception(f"[ContextEnhancerV2] 记录机器人回复时发生错误: {e}")
+            return
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[ContextEnhancerV2] 记录机器人回复: {response_text[:50]}...")
 
     async def clear_context_cache(self, group_id: Optional[str] = None):
         """
@@ -944,26 +1558,35 @@ class ContextEnhancerV2(Star):
         否则，清空所有群组的缓存。
         """
         try:
+            # 先完成加载，否则稍后加载的快照会让已清空的上下文重新出现
+            if not self._loaded:
+                await self._async_init()
             if group_id:
                 if group_id in self.group_messages:
-                    lock = self._get_or_create_lock(group_id)
-                    async with lock:
-                        # 使用 pop 安全地移除并返回条目，如果键不存在则返回 None，避免错误
-                        self.group_messages.pop(group_id, None)
-                        self.group_locks.pop(group_id, None)
-                        self.group_last_activity.pop(group_id, None)
+                    # 几次 pop 之间没有 await，不会与其他协程交错，无需等待群组锁
+                    self.group_messages.pop(group_id, None)
+                    self.group_last_activity.pop(group_id, None)
+                    # 写入清空标记，避免崩溃后重放追加日志时恢复已清空的消息
+                    self._enqueue_persist({"g": group_id, "clear": True})
                     logger.info(f"[ContextEnhancerV2] 已为群组 {group_id} 清理上下文缓存。")
             else:
-                async with self._global_lock:
-                    self.group_messages.clear()
-                self.group_last_activity.clear()
+                # 两次字典重新绑定之间没有 await，无需加锁；旧缓冲区随引用消失而释放
+                self.group_messages = {}
+                self.group_last_activity = {}
                 logger.info("[ContextEnhancerV2] 内存中的所有上下文缓存已清空。")
-                if await aio_os.path.exists(self.cache_path):
-                    await aio_remove(self.cache_path)
-                    logger.info(f"[ContextEnhancerV2] 持久化缓存文件 {self.cache_path} 已异步删除。")
+                # 提升代次与下限：队列中清空之前的记录全部作废，之后入队的记录照常写入新的日志
+                async with self._log_lock:
+                    self._persist_generation += 1
+                    self._persist_floor = self._persist_generation
+                    try:
+                        await aio_remove(self.cache_path)
+                        logger.info(f"[ContextEnhancerV2] 持久化缓存文件 {self.cache_path} 已异步删除。")
+                    except FileNotFoundError:
+                        pass
+                    await asyncio.to_thread(_remove_if_exists, self.log_path)
 
         except Exception as e:
-            logger.error(f"[ContextEnhancerV2] 清空上下文缓存时发生错误: {e}")
+            logger.exception(f"[ContextEnhancerV2] 清空上下文缓存时发生错误: {e}")
 
     @event_filter.command("reset", "new", description="清空当前群聊的上下文缓存")
     async def handle_clear_context_command(self, event: AstrMessageEvent):
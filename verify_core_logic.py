@@ -1,12 +1,15 @@
 import asyncio
+import json
 import unittest
 from unittest.mock import MagicMock, patch
 from collections import deque
-import datetime
+from typing import Optional
+import tempfile
 import time
+import os
 
 # 导入被测试的插件和相关类
-from main import ContextEnhancerV2, GroupMessage, ContextMessageType
+from main import ContextEnhancerV2, GroupMessage, ContextMessageType, ContextConstants, _compile_instruction, _atomic_write_bytes
 from astrbot.api import logger
 # 导入 verify_scenarios 中的模拟类以复用
 from verify_scenarios import MockSender, MockMessage, MockPlain, MockEvent
@@ -21,8 +24,8 @@ from verify_scenarios import MockSender, MockMessage, MockPlain, MockEvent
 })
 class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
     
-    async def _setup_plugin_with_config(self, config_overrides: dict):
-        """辅助函数：根据指定的配置覆盖来异步设置插件实例"""
+    async def _setup_plugin_with_config(self, config_overrides: dict, data_dir: Optional[str] = None):
+        """辅助函数：根据指定的配置覆盖来异步设置插件实例；指定 data_dir 时从该目录加载并保留持久化的缓存"""
         mock_context = MagicMock()
         mock_config = MagicMock()
 
@@ -40,22 +43,42 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
         mock_config.get.side_effect = mock_get
         
         plugin = ContextEnhancerV2(mock_context, mock_config)
+        if data_dir is not None:
+            plugin.data_dir = data_dir
+            plugin.cache_path = os.path.join(data_dir, "context_cache.json")
+            plugin.log_path = os.path.join(data_dir, "context_cache.log.jsonl")
         await plugin._async_init() # 安全地进行异步初始化
-        plugin.group_messages = {} 
+        if data_dir is None:
+            plugin.group_messages = {}
+            plugin.group_last_activity = {}
         return plugin
 
+    def _make_temp_dir(self) -> str:
+        """辅助函数：创建测试结束后自动删除的临时数据目录"""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        return temp_dir.name
+
+    async def _send_message(self, plugin, group_id: str, sender_id: str, text: str):
+        """辅助函数：模拟群成员发送一条纯文本消息"""
+        mock_event = MockEvent()
+        mock_event.message_obj = MockMessage(MockSender(sender_id, f"User_{sender_id}"), [MockPlain(text)])
+        mock_event.message_str = text
+        with patch.object(mock_event, 'get_group_id', return_value=group_id):
+            await plugin.on_message(mock_event)
+
     async def test_is_duplicate_message_with_varied_configs(self):
         """测试 _is_duplicate_message 函数在不同配置下的行为"""
         logger.info(f"\n--- Running test: {self._testMethodName} ---")
 
         sender = MockSender("user1", "Alice")
-        now = datetime.datetime.now()
+        now = time.time()
         
         existing_msg = GroupMessage(
             message_type=ContextMessageType.NORMAL_CHAT, sender_id=sender.user_id, sender_name=sender.nickname,
             group_id="group_1", text_content="Hello"
         )
-        existing_msg.timestamp = now - datetime.timedelta(seconds=10)
+        existing_msg.timestamp = now - 10
         
         new_msg = GroupMessage(
             message_type=ContextMessageType.NORMAL_CHAT, sender_id=sender.user_id, sender_name=sender.nickname,
@@ -67,28 +90,32 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
         plugin_default = await self._setup_plugin_with_config({})
         buffers_default = await plugin_default._get_or_create_group_buffers("group_1")
         buffers_default.recent_chats.append(existing_msg)
-        self.assertTrue(plugin_default._is_duplicate_message(buffers_default.recent_chats, new_msg), "在默认配置下，此消息应被视为重复")
+        buffers_default.recent_chats_index.record(existing_msg)
+        self.assertTrue(plugin_default._is_duplicate_message(buffers_default.recent_chats_index, new_msg), "在默认配置下，此消息应被视为重复")
 
         logger.info("场景2: 缩短去重时间，应不视为重复")
         plugin_short_time = await self._setup_plugin_with_config({"duplicate_check_time_seconds": 5})
         buffers_short_time = await plugin_short_time._get_or_create_group_buffers("group_1")
         buffers_short_time.recent_chats.append(existing_msg)
-        self.assertFalse(plugin_short_time._is_duplicate_message(buffers_short_time.recent_chats, new_msg), "缩短去重时间后，此消息不应被视为重复")
+        buffers_short_time.recent_chats_index.record(existing_msg)
+        self.assertFalse(plugin_short_time._is_duplicate_message(buffers_short_time.recent_chats_index, new_msg), "缩短去重时间后，此消息不应被视为重复")
 
         logger.info("场景3: 缩小去重窗口，应不视为重复")
         plugin_small_window = await self._setup_plugin_with_config({"duplicate_check_window_messages": 2})
         buffers_small_window = await plugin_small_window._get_or_create_group_buffers("group_1")
         
         buffers_small_window.recent_chats.append(existing_msg)
+        buffers_small_window.recent_chats_index.record(existing_msg)
         for i in range(3):
             filler_msg = GroupMessage(
                 message_type=ContextMessageType.NORMAL_CHAT, sender_id="filler", sender_name="Filler",
                 group_id="group_1", text_content=f"filler {i}"
             )
-            filler_msg.timestamp = now - datetime.timedelta(seconds=5 - i)
+            filler_msg.timestamp = now - (5 - i)
             buffers_small_window.recent_chats.append(filler_msg)
+            buffers_small_window.recent_chats_index.record(filler_msg)
 
-        self.assertFalse(plugin_small_window._is_duplicate_message(buffers_small_window.recent_chats, new_msg), "缩小消息窗口后，此消息不应被视为重复")
+        self.assertFalse(plugin_small_window._is_duplicate_message(buffers_small_window.recent_chats_index, new_msg), "缩小消息窗口后，此消息不应被视为重复")
         
         logger.info("Test Passed: _is_duplicate_message 函数对配置更改的响应符合预期。")
 
@@ -98,17 +125,19 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
         plugin = await self._setup_plugin_with_config({})
         buffers = await plugin._get_or_create_group_buffers("group_dedupe")
         buffer = buffers.recent_chats
+        index = buffers.recent_chats_index
         
         sender1 = MockSender("user1", "Alice")
         sender2 = MockSender("user2", "Bob")
-        now = datetime.datetime.now()
+        now = time.time()
 
         base_msg = GroupMessage(
             message_type=ContextMessageType.NORMAL_CHAT, sender_id=sender1.user_id, sender_name=sender1.nickname,
             group_id="group_dedupe", text_content="Same content"
         )
-        base_msg.timestamp = now - datetime.timedelta(seconds=15)
+        base_msg.timestamp = now - 15
         buffer.append(base_msg)
+        index.record(base_msg)
 
         logger.info("场景1: 完全重复的消息")
         duplicate_msg = GroupMessage(
@@ -116,7 +145,7 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
             group_id="group_dedupe", text_content="Same content"
         )
         duplicate_msg.timestamp = now
-        self.assertTrue(plugin._is_duplicate_message(buffer, duplicate_msg), "完全重复的消息应该被识别")
+        self.assertTrue(plugin._is_duplicate_message(index, duplicate_msg), "完全重复的消息应该被识别")
 
         logger.info("场景2: 不同发送者")
         msg_from_another_sender = GroupMessage(
@@ -124,7 +153,7 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
             group_id="group_dedupe", text_content="Same content"
         )
         msg_from_another_sender.timestamp = now
-        self.assertFalse(plugin._is_duplicate_message(buffer, msg_from_another_sender), "不同发送者的消息不应视为重复")
+        self.assertFalse(plugin._is_duplicate_message(index, msg_from_another_sender), "不同发送者的消息不应视为重复")
 
         logger.info("场景3: 不同内容")
         msg_with_different_content = GroupMessage(
@@ -132,15 +161,15 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
             group_id="group_dedupe", text_content="Different content"
         )
         msg_with_different_content.timestamp = now
-        self.assertFalse(plugin._is_duplicate_message(buffer, msg_with_different_content), "不同内容的消息不应视为重复")
+        self.assertFalse(plugin._is_duplicate_message(index, msg_with_different_content), "不同内容的消息不应视为重复")
 
         logger.info("场景4: 超出时间窗口")
         msg_out_of_time = GroupMessage(
             message_type=ContextMessageType.NORMAL_CHAT, sender_id=sender1.user_id, sender_name=sender1.nickname,
             group_id="group_dedupe", text_content="Same content"
         )
-        msg_out_of_time.timestamp = now + datetime.timedelta(seconds=40)
-        self.assertFalse(plugin._is_duplicate_message(buffer, msg_out_of_time), "超出时间窗口的消息不应视为重复")
+        msg_out_of_time.timestamp = now + 40
+        self.assertFalse(plugin._is_duplicate_message(index, msg_out_of_time), "超出时间窗口的消息不应视为重复")
 
         logger.info("场景5: 包含图片")
         msg_with_image = GroupMessage(
@@ -148,7 +177,7 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
             group_id="group_dedupe", text_content="Same content", images=[MagicMock()]
         )
         msg_with_image.timestamp = now
-        self.assertFalse(plugin._is_duplicate_message(buffer, msg_with_image), "包含图片的消息永远不应视为重复")
+        self.assertFalse(plugin._is_duplicate_message(index, msg_with_image), "包含图片的消息永远不应视为重复")
 
         logger.info("Test Passed: _is_duplicate_message 的所有核心场景均按预期工作。")
 
@@ -158,7 +187,7 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
         
         plugin = await self._setup_plugin_with_config({"inactive_cleanup_days": 10})
         
-        now = datetime.datetime.now()
+        now = time.monotonic()
 
         def create_dummy_message(group_id, text):
             return GroupMessage(
@@ -169,11 +198,11 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
         # 使用新的数据结构
         active_buffers = await plugin._get_or_create_group_buffers("active_group")
         active_buffers.recent_chats.append(create_dummy_message("active_group", "message1"))
-        plugin.group_last_activity["active_group"] = now - datetime.timedelta(days=5)
+        plugin.group_last_activity["active_group"] = now - 5 * 86400
         
         inactive_buffers = await plugin._get_or_create_group_buffers("inactive_group")
         inactive_buffers.recent_chats.append(create_dummy_message("inactive_group", "message2"))
-        plugin.group_last_activity["inactive_group"] = now - datetime.timedelta(days=15)
+        plugin.group_last_activity["inactive_group"] = now - 15 * 86400
         
         another_active_buffers = await plugin._get_or_create_group_buffers("another_active_group")
         another_active_buffers.recent_chats.append(create_dummy_message("another_active_group", "message3"))
@@ -191,6 +220,90 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
         
         logger.info("Test Passed: _cleanup_inactive_groups 成功清理了不活跃群组。")
 
+    async def test_lru_eviction_order(self):
+        """测试缓存群组数超过上限时，按最近活跃顺序淘汰最久未活跃的群组"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        plugin = await self._setup_plugin_with_config({})
+
+        with patch.object(ContextConstants, "MAX_CACHED_GROUPS", 3):
+            for group_id in ("group_1", "group_2", "group_3"):
+                await plugin._get_or_create_group_buffers(group_id)
+            logger.info("场景1: 再次访问 group_1，使其成为最近活跃的群组")
+            group_1_buffers = await plugin._get_or_create_group_buffers("group_1")
+            self.assertEqual(list(plugin.group_messages), ["group_2", "group_3", "group_1"])
+
+            logger.info("场景2: 新群组加入时淘汰最久未活跃的 group_2")
+            await plugin._get_or_create_group_buffers("group_4")
+            self.assertEqual(list(plugin.group_messages), ["group_3", "group_1", "group_4"], "应淘汰最久未活跃的群组")
+            self.assertNotIn("group_2", plugin.group_last_activity, "被淘汰群组的活动记录应一并清理")
+            self.assertIs(plugin.group_messages["group_1"], group_1_buffers, "再次访问不应重建缓冲区")
+
+            logger.info("场景3: 连续加入新群组时依次淘汰")
+            await plugin._get_or_create_group_buffers("group_5")
+            await plugin._get_or_create_group_buffers("group_6")
+            self.assertEqual(list(plugin.group_messages), ["group_4", "group_5", "group_6"])
+
+        logger.info("Test Passed: LRU 淘汰顺序正确。")
+
+    async def test_cleanup_task_prunes_inactive_groups(self):
+        """测试首次创建缓冲区时启动的后台清理任务会定时清理不活跃群组"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        plugin = await self._setup_plugin_with_config({"inactive_cleanup_days": 1, "cleanup_interval_seconds": 0.01})
+
+        await plugin._get_or_create_group_buffers("inactive_group")
+        await plugin._get_or_create_group_buffers("active_group")
+        self.assertIsNotNone(plugin._cleanup_task, "首次创建缓冲区时应启动后台清理任务")
+        plugin.group_last_activity["inactive_group"] = time.monotonic() - 2 * 86400
+
+        await asyncio.sleep(0.05)
+
+        self.assertNotIn("inactive_group", plugin.group_messages, "后台任务应清理不活跃群组")
+        self.assertIn("active_group", plugin.group_messages, "活跃群组不应被清理")
+        plugin._cleanup_task.cancel()
+
+        logger.info("Test Passed: 后台清理任务按间隔清理了不活跃群组。")
+
+    async def test_no_buffers_or_tasks_after_terminate(self):
+        """测试 terminate 开始后不再创建缓冲区，也不会重新启动清理与写入任务"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        # 使用临时目录，避免终止时写入的快照影响其他测试
+        plugin = await self._setup_plugin_with_config({}, data_dir=self._make_temp_dir())
+
+        await plugin.terminate(MagicMock())
+
+        mock_event = MockEvent()
+        mock_event.message_obj = MockMessage(MockSender("user_late", "LateSender"), [MockPlain("终止后的消息")])
+        mock_event.message_str = "终止后的消息"
+        resp = MagicMock()
+        resp.completion_text = "终止后的回复"
+        with patch.object(mock_event, 'get_group_id', return_value='group_after_terminate'):
+            await plugin.on_message(mock_event)
+            await plugin.on_llm_response(mock_event, resp)
+
+        self.assertNotIn("group_after_terminate", plugin.group_messages, "终止后不应再创建缓冲区")
+        self.assertIsNone(plugin._cleanup_task, "终止后不应重新启动清理任务")
+        self.assertIsNone(plugin._writer_task, "终止后不应重新启动写入任务")
+
+        logger.info("Test Passed: terminate 之后插件不再创建缓冲区或后台任务。")
+
+    async def test_zero_capacity_buffer_does_not_track_nonce(self):
+        """测试容量为 0 的缓冲区不会登记 nonce，避免 nonce_index 中残留永远不会被移除的消息"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        plugin = await self._setup_plugin_with_config({"max_context_images": 0})
+        buffers = plugin._create_new_group_buffers()
+
+        msg = GroupMessage(
+            message_type=ContextMessageType.IMAGE_MESSAGE, sender_id="user1", sender_name="User",
+            group_id="group_zero", text_content="", images=["http://example.com/a.jpg"], nonce="nonce-1"
+        )
+        buffers.track_nonce(buffers.image_messages, msg)
+        buffers.image_messages.append(msg)
+
+        self.assertEqual(len(buffers.image_messages), 0)
+        self.assertNotIn("nonce-1", buffers.nonce_index, "未被保留的消息不应登记 nonce")
+
+        logger.info("Test Passed: 容量为 0 的缓冲区未登记 nonce。")
+
     async def test_empty_message_handling(self):
         """测试插件是否会忽略完全为空（无文本、无图片）的消息"""
         logger.info(f"\n--- Running test: {self._testMethodName} ---")
@@ -208,6 +321,301 @@ class TestCoreLogic(unittest.IsolatedAsyncioTestCase):
 
         logger.info("Test Passed: 插件成功忽略了空消息。")
 
+    async def test_replay_log_restores_messages_and_compacts(self):
+        """测试未正常终止时，新实例加载会重放追加日志恢复消息，并把日志压缩进快照"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        data_dir = self._make_temp_dir()
+        plugin = await self._setup_plugin_with_config({"recent_chats_count": 3}, data_dir=data_dir)
+
+        logger.info("场景1: 写入超过缓冲区容量的消息后模拟崩溃（只写完日志，不执行 terminate）")
+        for i in range(10):
+            await self._send_message(plugin, "group_replay", f"user{i}", f"message {i}")
+        await plugin._stop_writer()
+        self.assertTrue(os.path.exists(plugin.log_path), "消息应已写入追加日志")
+        expected = [msg.text_content for msg in plugin.group_messages["group_replay"].recent_chats]
+        self.assertLess(len(expected), 10, "缓冲区容量应小于写入的消息数")
+
+        logger.info("场景2: 新实例加载时重放日志，每个缓冲区只恢复容量以内的最新消息")
+        restored = await self._setup_plugin_with_config({"recent_chats_count": 3}, data_dir=data_dir)
+        buffers = restored.group_messages["group_replay"]
+        self.assertEqual(
+            [msg.text_content for msg in buffers.recent_chats], expected,
+            "应只恢复缓冲区容量以内的最新消息"
+        )
+        self.assertIn("group_replay", restored.group_last_activity, "恢复的群组应登记活动时间以参与定时清理")
+
+        logger.info("场景3: 重放后日志被压缩进快照")
+        self.assertFalse(os.path.exists(restored.log_path), "重放后追加日志应被删除")
+        self.assertTrue(os.path.exists(restored.cache_path), "重放后应写入新的快照")
+        reloaded = await self._setup_plugin_with_config({"recent_chats_count": 3}, data_dir=data_dir)
+        self.assertEqual(
+            [msg.text_content for msg in reloaded.group_messages["group_replay"].recent_chats], expected,
+            "从压缩后的快照加载应得到相同的消息"
+        )
+
+        logger.info("Test Passed: 追加日志被正确重放并压缩。")
+
+    async def test_replay_honors_tombstones_and_group_limit(self):
+        """测试重放时遵守清空标记、LRU 淘汰标记与 MAX_CACHED_GROUPS，并跳过写了一半的记录"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        data_dir = self._make_temp_dir()
+
+        with patch.object(ContextConstants, "MAX_CACHED_GROUPS", 2):
+            logger.info("场景1: 运行期被 LRU 淘汰或被 reset 的群组在重放后不会复活")
+            plugin = await self._setup_plugin_with_config({}, data_dir=data_dir)
+            await self._send_message(plugin, "group_1", "user1", "hello 1")
+            await self._send_message(plugin, "group_2", "user2", "hello 2")
+            await self._send_message(plugin, "group_3", "user3", "hello 3")  # 淘汰 group_1
+            await plugin.clear_context_cache("group_3")
+            await plugin._stop_writer()
+            with open(plugin.log_path, "rb") as f:
+                records = [json.loads(line) for line in f]
+            self.assertIn({"g": "group_1", "clear": True}, records, "LRU 淘汰群组时应写入清空标记")
+
+            restored = await self._setup_plugin_with_config({}, data_dir=data_dir)
+            self.assertEqual(list(restored.group_messages), ["group_2"], "只有未被淘汰或清空的群组应被恢复")
+            await restored._stop_writer()
+
+            logger.info("场景2: 日志中的群组超过上限时只恢复最近写入的群组，损坏的行被跳过")
+            with open(restored.log_path, "ab") as f:
+                for group_id in ("group_a", "group_b", "group_c"):
+                    msg = GroupMessage(
+                        message_type=ContextMessageType.NORMAL_CHAT, sender_id="user",
+                        sender_name="User", group_id=group_id, text_content=f"hi from {group_id}"
+                    )
+                    f.write(json.dumps({"g": group_id, "m": msg.to_dict()}).encode("utf-8") + b"\n")
+                f.write(b'{"g": "group_d", "m": {"text_con')  # 模拟崩溃时写了一半的记录
+
+            reloaded = await self._setup_plugin_with_config({}, data_dir=data_dir)
+            self.assertEqual(list(reloaded.group_messages), ["group_b", "group_c"], "应只保留最近写入的 2 个群组")
+            self.assertEqual(reloaded.group_messages["group_c"].recent_chats[0].text_content, "hi from group_c")
+
+        logger.info("Test Passed: 重放正确处理了清空标记与群组上限。")
+
+    async def test_compaction_keeps_later_records_without_duplicates(self):
+        """测试压缩之后入队的记录照常写入日志，压缩前入队的记录不会在重放时重复出现"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        data_dir = self._make_temp_dir()
+        plugin = await self._setup_plugin_with_config({}, data_dir=data_dir)
+
+        await self._send_message(plugin, "group_compact", "user1", "before compaction")
+        await plugin._compact_persisted_cache()
+        await self._send_message(plugin, "group_compact", "user2", "after compaction")
+        await plugin._stop_writer()
+
+        restored = await self._setup_plugin_with_config({}, data_dir=data_dir)
+        self.assertEqual(
+            [msg.text_content for msg in restored.group_messages["group_compact"].recent_chats],
+            ["before compaction", "after compaction"],
+            "压缩前后的消息都应恢复，且各只出现一次"
+        )
+
+        logger.info("Test Passed: 压缩与追加日志的衔接正确。")
+
+    async def test_cleanup_task_compacts_append_log(self):
+        """测试后台任务会定期把追加日志压缩进快照，崩溃时无需重放不断增长的日志"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        data_dir = self._make_temp_dir()
+        plugin = await self._setup_plugin_with_config({"cleanup_interval_seconds": 0.01}, data_dir=data_dir)
+
+        await self._send_message(plugin, "group_periodic", "user1", "periodic message")
+        await asyncio.sleep(0.1)
+
+        self.assertFalse(os.path.exists(plugin.log_path), "定时压缩后追加日志应被删除")
+        self.assertTrue(os.path.exists(plugin.cache_path), "定时压缩应写入快照")
+        self.assertEqual(plugin._log_records_written, 0)
+        plugin._cleanup_task.cancel()
+
+        restored = await self._setup_plugin_with_config({}, data_dir=data_dir)
+        self.assertEqual(
+            [msg.text_content for msg in restored.group_messages["group_periodic"].recent_chats],
+            ["periodic message"],
+            "从定时压缩写入的快照应能恢复消息"
+        )
+
+        logger.info("Test Passed: 后台任务定期压缩了追加日志。")
+
+    async def test_terminate_waits_for_inflight_compaction(self):
+        """测试 terminate 取消清理任务时，进行中的定时压缩不会与终止时的快照写入交错"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        data_dir = self._make_temp_dir()
+        plugin = await self._setup_plugin_with_config({"cleanup_interval_seconds": 0.01}, data_dir=data_dir)
+
+        original_write = _atomic_write_bytes
+        write_started = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        active_writes = []
+        overlapping = []
+
+        def slow_write(path, temp_path, data):
+            # 模拟耗时的磁盘写入，并记录是否有两个写入同时进行
+            overlapping.append(bool(active_writes))
+            active_writes.append(temp_path)
+            loop.call_soon_threadsafe(write_started.set)
+            time.sleep(0.1)
+            try:
+                original_write(path, temp_path, data)
+            finally:
+                active_writes.pop()
+
+        await self._send_message(plugin, "group_inflight", "user1", "before terminate")
+        with patch("main._atomic_write_bytes", slow_write):
+            await asyncio.wait_for(write_started.wait(), timeout=2)
+            await self._send_message(plugin, "group_inflight", "user2", "during compaction")
+            await plugin.terminate(MagicMock())
+
+        self.assertEqual(overlapping, [False, False], "定时压缩与终止快照的写入不应交错")
+        self.assertFalse(os.path.exists(plugin.cache_path + ".tmp"), "临时文件应被清理")
+        restored = await self._setup_plugin_with_config({}, data_dir=data_dir)
+        self.assertEqual(
+            [msg.text_content for msg in restored.group_messages["group_inflight"].recent_chats],
+            ["before terminate", "during compaction"],
+            "终止时的快照应包含全部消息"
+        )
+
+        logger.info("Test Passed: terminate 等待了进行中的压缩。")
+
+    async def test_compile_instruction_matches_str_format(self):
+        """测试预编译的指令模板与 str.format 的结果（包括抛出的异常）保持一致"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        kwargs = {"sender_name": "李四", "sender_id": 10002, "original_prompt": "说{点}什么"}
+        templates = [
+            '群成员 {sender_name} (ID: {sender_id}) 说："{original_prompt}"',
+            "没有任何占位符的模板",
+            "",
+            "{{转义的花括号}} {sender_name} {{sender_id}}",
+            "{original_prompt}{original_prompt}",
+            "{sender_id:>8} {sender_name!r}",  # 格式说明符与转换符：回退为 str.format
+            "{sender_name.upper}",  # 属性访问：回退为 str.format
+            "{missing_key} {sender_name}",  # 缺少的字段
+            "{}",  # 位置参数
+            "{sender_name",  # 未闭合的花括号
+            "}单独的右花括号",
+        ]
+        for template in templates:
+            with self.subTest(template=template):
+                try:
+                    expected = template.format(**kwargs)
+                except Exception as e:
+                    with self.assertRaises(type(e), msg="应抛出与 str.format 相同类型的异常"):
+                        _compile_instruction(template)(**kwargs)
+                else:
+                    self.assertEqual(_compile_instruction(template)(**kwargs), expected)
+
+        logger.info("Test Passed: _compile_instruction 与 str.format 行为一致。")
+
+    async def test_keyword_trigger_prefix_matching(self):
+        """测试命令前缀匹配（含首字符快速排除）在大小写混合、空文本和空前缀下的行为"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+
+        def make_event(text):
+            mock_event = MockEvent()
+            mock_event.message_str = text
+            return mock_event
+
+        logger.info("场景1: 大小写混合的前缀与消息")
+        plugin = await self._setup_plugin_with_config({"command_prefixes": ["/", "Reset", "！"]})
+        cases = {
+            "RESET please": True,
+            "reset": True,
+            "rEsEt": True,
+            "  /help": True,
+            "！状态": True,
+            "Res": False,
+            "hello /help": False,
+            "Hello": False,
+            "": False,
+            "   ": False,
+            None: False,
+        }
+        for text, expected in cases.items():
+            with self.subTest(text=text):
+                self.assertEqual(plugin._is_keyword_triggered(make_event(text)), expected)
+                # 与不带快速路径的朴素实现保持一致
+                stripped = (text or "").lstrip()
+                naive = bool(stripped) and stripped.lower().startswith(plugin.config.command_prefixes)
+                self.assertEqual(plugin._is_keyword_triggered(make_event(text)), naive)
+
+        logger.info("场景2: 只有无大小写之分的前缀时不做 lower()，结果不变")
+        plugin = await self._setup_plugin_with_config({"command_prefixes": ["/", "#"]})
+        self.assertFalse(plugin._command_prefixes_cased)
+        self.assertTrue(plugin._is_keyword_triggered(make_event("#Topic")))
+        self.assertFalse(plugin._is_keyword_triggered(make_event("Topic #1")))
+
+        logger.info("场景3: 配置了空前缀时任何非空消息都视为命令，空消息仍不触发")
+        plugin = await self._setup_plugin_with_config({"command_prefixes": ["", "/"]})
+        self.assertIsNone(plugin._command_prefix_firstchars, "存在空前缀时不应使用首字符快速路径")
+        self.assertTrue(plugin._is_keyword_triggered(make_event("随便说点什么")))
+        self.assertFalse(plugin._is_keyword_triggered(make_event("")))
+
+        logger.info("Test Passed: 命令前缀匹配在各种输入下均按预期工作。")
+
+    async def test_bot_reply_echo_not_stored_twice(self):
+        """测试机器人回复被记录后，平台回显的同一条消息不会再次存入 bot_replies"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        plugin = await self._setup_plugin_with_config({"bot_replies_count": 5})
+
+        logger.info("场景1: on_llm_response 记录机器人回复")
+        event = MockEvent()
+        event.message_obj = MockMessage(MockSender("10002", "李四"), [MockPlain("在吗")])
+        resp = MagicMock()
+        resp.completion_text = "hello there"
+        with patch.object(event, 'get_group_id', return_value='group_echo_test'):
+            await plugin.on_llm_response(event, resp)
+
+        logger.info("场景2: 平台回显机器人自己发出的同一条消息")
+        echo_event = MockEvent()
+        echo_event.message_obj = MockMessage(MockSender("self_123", "Bot"), [MockPlain("hello there")])
+        echo_event.message_str = "hello there"
+        with patch.object(echo_event, 'get_group_id', return_value='group_echo_test'):
+            await plugin.on_message(echo_event)
+
+        buffers = plugin.group_messages["group_echo_test"]
+        self.assertEqual(
+            [msg.text_content for msg in buffers.bot_replies], ["hello there"],
+            "机器人回复与其回显只应存储一次"
+        )
+
+        logger.info("Test Passed: 机器人回复的回显被正确识别为重复。")
+
+    async def test_identical_bot_replies_are_both_kept(self):
+        """测试 LLM 连续两次给出相同的回复时，两条回复都会被记录"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        plugin = await self._setup_plugin_with_config({"bot_replies_count": 5})
+
+        event = MockEvent()
+        event.message_obj = MockMessage(MockSender("10002", "李四"), [MockPlain("在吗")])
+        resp = MagicMock()
+        resp.completion_text = "好的"
+        with patch.object(event, 'get_group_id', return_value='group_repeat_reply'):
+            await plugin.on_llm_response(event, resp)
+            await plugin.on_llm_response(event, resp)
+
+        buffers = plugin.group_messages["group_repeat_reply"]
+        self.assertEqual(
+            [msg.text_content for msg in buffers.bot_replies], ["好的", "好的"],
+            "相同内容的两次机器人回复都应被保留"
+        )
+
+        logger.info("Test Passed: 相同的机器人回复均被保留。")
+
+    async def test_empty_llm_response_not_recorded(self):
+        """测试 completion_text 为空字符串（如工具调用轮次）的响应不会被记录为机器人回复"""
+        logger.info(f"\n--- Running test: {self._testMethodName} ---")
+        plugin = await self._setup_plugin_with_config({"bot_replies_count": 5})
+
+        event = MockEvent()
+        event.message_obj = MockMessage(MockSender("10002", "李四"), [MockPlain("在吗")])
+        for text in ("", "   "):
+            resp = MagicMock()
+            resp.completion_text = text
+            with patch.object(event, 'get_group_id', return_value='group_empty_reply'):
+                await plugin.on_llm_response(event, resp)
+
+        self.assertIsNone(plugin.group_messages.get("group_empty_reply"), "空回复不应该创建任何上下文缓存")
+
+        logger.info("Test Passed: 空的 LLM 响应被正确跳过。")
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -115,13 +115,10 @@ class TestImagePassing(unittest.IsolatedAsyncioTestCase):
             sender_name=sender.nickname,
             group_id=group_id,
             text_content="",
-            images=[MockImage(image_url)]
+            images=[image_url]
         )
 
-        # 手动生成图片描述
-        await self.plugin._generate_image_captions(image_msg)
-        
-        # 将历史消息放入缓冲区
+        # 将历史消息放入缓冲区（此时尚未生成图片描述）
         buffers = await self.plugin._get_or_create_group_buffers(group_id)
         buffers.recent_chats.append(image_msg)
 
@@ -135,13 +132,88 @@ class TestImagePassing(unittest.IsolatedAsyncioTestCase):
         )
 
         # 4. 断言检查
+        # 检查图片描述是否在进入上下文时才延迟生成，并写回消息
+        self.plugin.image_caption_utils.generate_image_caption.assert_awaited_once()
+        self.assertEqual(image_msg.image_captions, ["一只猫"])
+
         # 检查 prompt 是否包含图片描述
-        expected_context = "测试用户:  [图片: 一只猫]"
+        expected_context = "测试用户: [Image: 一只猫]"
         self.assertIn(expected_context, request.prompt)
         
         # 检查 image_urls 是否包含原始图片 URL
         self.assertIn(image_url, request.image_urls)
 
+    async def test_concurrent_requests_caption_image_once(self):
+        """并发的 on_llm_request 选中同一条图片消息时，只生成一次图片描述"""
+        group_id = "test_group_456"
+        sender = MockSender("测试用户", "user_1")
+        image_url = "http://example.com/dog.jpg"
+
+        image_msg = GroupMessage(
+            message_type=ContextMessageType.IMAGE_MESSAGE,
+            sender_id=sender.user_id,
+            sender_name=sender.nickname,
+            group_id=group_id,
+            text_content="",
+            images=[image_url]
+        )
+        buffers = await self.plugin._get_or_create_group_buffers(group_id)
+        buffers.recent_chats.append(image_msg)
+
+        # 让描述生成挂起一段时间，保证两个请求在生成完成前都已选中该消息
+        async def slow_caption(*args, **kwargs):
+            await asyncio.sleep(0.05)
+            return "一只狗"
+        self.plugin.image_caption_utils.generate_image_caption = AsyncMock(side_effect=slow_caption)
+
+        requests = [MockProviderRequest("看这张图"), MockProviderRequest("这是什么")]
+        await asyncio.gather(*(
+            self.plugin.on_llm_request(
+                cast("AstrMessageEvent", MockAstrMessageEvent(sender, [MockPlain(req.prompt)], group_id)),
+                cast("ProviderRequest", req),
+            )
+            for req in requests
+        ))
+
+        self.plugin.image_caption_utils.generate_image_caption.assert_awaited_once()
+        self.assertEqual(image_msg.image_captions, ["一只狗"])
+        for req in requests:
+            self.assertIn("测试用户: [Image: 一只狗]", req.prompt)
+
+    async def test_baseline_cache_entry_is_not_recaptioned(self):
+        """旧版缓存把图片描述拼在 text_content 中，加载后不应重新生成描述，描述也只出现一次"""
+        group_id = "test_group_789"
+        image_url = "http://example.com/bird.jpg"
+        # 旧版 to_dict 写出的格式：ISO 时间戳，image_captions 为空，描述已拼入 text_content
+        baseline_entry = {
+            "id": "msg1",
+            "nonce": None,
+            "message_type": ContextMessageType.IMAGE_MESSAGE,
+            "timestamp": "2025-09-08T13:09:19.057952",
+            "sender_name": "测试用户",
+            "sender_id": "user_1",
+            "group_id": group_id,
+            "text_content": "快看[Image: 一只鸟; 蓝天]",
+            "has_image": True,
+            "image_captions": [],
+            "images": [image_url],
+            "raw_components": [],
+        }
+        self.plugin.group_messages.update(self.plugin._load_group_messages_from_dict({group_id: [baseline_entry]}))
+        image_msg = self.plugin.group_messages[group_id].image_messages[0]
+        self.assertEqual(image_msg.text_content, "快看")
+        self.assertEqual(image_msg.image_captions, ["一只鸟", "蓝天"])
+
+        request = MockProviderRequest("这是什么鸟")
+        await self.plugin.on_llm_request(
+            cast("AstrMessageEvent", MockAstrMessageEvent(MockSender("测试用户", "user_1"), [MockPlain("这是什么鸟")], group_id)),
+            cast("ProviderRequest", request),
+        )
+
+        self.plugin.image_caption_utils.generate_image_caption.assert_not_awaited()
+        self.assertEqual(request.prompt.count("[Image: 一只鸟; 蓝天]"), 1)
+        self.assertIn(image_url, request.image_urls)
+
 
 # 使用 patch.dict 来模拟 sys.modules，避免 ModuleNotFoundError
 @patch.dict('sys.modules', {
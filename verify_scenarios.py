@@ -33,6 +33,9 @@ class MockMessage:
         self.message = message or []
 
 class MockEvent(MagicMock):
+    # 真实事件没有 id 属性；显式置空，避免 MagicMock 自动生成无法序列化的子 mock 被写入缓存
+    id = None
+
     def get_sender_id(self):
         if self.message_obj and self.message_obj.sender:
             return self.message_obj.sender.user_id
@@ -141,6 +144,33 @@ class TestContextEnhancerScenarios(unittest.IsolatedAsyncioTestCase):
         
         logger.info("Test Passed: 被动回复场景按预期工作。")
 
+    async def test_passive_trigger_message_found_by_nonce(self):
+        """测试被动触发的消息在入队时带上 nonce，on_llm_request 能精确找到触发消息"""
+        logger.info("Step 1: 构造一条 @ 机器人的消息并交给 on_message 入队")
+        event = MockEvent()
+        bot_id = "self_123"
+        event.message_obj = MockMessage(
+            MockSender("10002", "李四"),
+            [At(qq=bot_id), MockPlain(" 你有什么建议吗？")]
+        )
+        event.message_str = f"@{bot_id} 你有什么建议吗？"
+        await self.plugin.on_message(event)
+
+        logger.info("Step 2: 验证入队的消息带有事件上的 nonce，且已登记到 nonce_index")
+        nonce = getattr(event, '_context_enhancer_nonce', None)
+        self.assertIsInstance(nonce, str, "被动触发的事件应被附加 nonce")
+        buffers = self.plugin.group_messages["test_group_123"]
+        stored_msg = buffers.recent_chats[-1]
+        self.assertEqual(stored_msg.nonce, nonce, "入队消息的 nonce 应与事件一致")
+        self.assertIs(buffers.nonce_index.get(nonce), stored_msg, "nonce_index 应指向入队的消息")
+
+        logger.info("Step 3: 验证 _find_triggering_message_from_event 通过 nonce 命中触发消息")
+        trigger_msg, scene = self.plugin._find_triggering_message_from_event(buffers, event)
+        self.assertIs(trigger_msg, stored_msg, "应精确找到触发消息")
+        self.assertEqual(scene, "被动回复")
+
+        logger.info("Test Passed: 被动触发消息可通过 nonce 精确匹配。")
+
     async def test_proactive_system_trigger_scenario(self):
         """测试场景二：系统主动触发"""
         logger.info("Step 1: 构造一个没有用户信息的 Event 对象 (sender=None)")